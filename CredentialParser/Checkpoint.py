@@ -0,0 +1,52 @@
+import json
+import logging
+import os
+from threading import Lock
+from typing import Optional
+
+
+class Checkpoint:
+    """Records how far each input file has got in a small JSON state file.
+
+    Entries are keyed by absolute path and hold the byte offset of the
+    last line whose output was safely flushed, along with the line count
+    and whatever the output handler needs to roll back to that point. The
+    file is replaced atomically so a crash while writing it can't corrupt
+    it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(filename: str) -> str:
+        return os.path.abspath(filename)
+
+    def get(self, filename: str) -> Optional[dict]:
+        """Get the entry for a file, if it hasn't changed since it was written."""
+        with self.lock:
+            entry = self.entries.get(self.key(filename))
+        if entry is None:
+            return None
+        stat = os.stat(filename)
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            logging.warning(f"{filename} has changed since it was checkpointed. Starting from the beginning.")
+            return None
+        return entry
+
+    def update(self, filename: str, **entry):
+        stat = os.stat(filename)
+        entry.update(size=stat.st_size, mtime=stat.st_mtime)
+        with self.lock:
+            self.entries[self.key(filename)] = entry
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
@@ -1,11 +1,18 @@
+import re
 from argparse import FileType
-from CredentialParser.util import str_index, timestr
+from CredentialParser.util import count_lines, naturaldelta, naturalsize, timestr
+from CredentialParser.Reader import BlockReader, DEFAULT_BLOCK_SIZE, InputFile, detect_compression, input_size, iter_ranges, read_range
+from collections import Counter, deque
+from concurrent.futures import Executor, FIRST_COMPLETED, ProcessPoolExecutor, wait
 from threading import Thread
 from enum import Enum
-from typing import Any, Callable, IO, Iterable, List, Optional
+from typing import Any, Callable, IO, Iterable, List, Optional, Tuple
 from datetime import datetime, timedelta
+from time import perf_counter
 from CredentialParser.OutputHandler import LoggingHandler, OutputHandler, PrintHandler
-import humanize
+from CredentialParser.Checkpoint import Checkpoint
+from CredentialParser.Stats import Stats
+import logging
 
 class ParsingMode(Enum):
     FIRST_FOUND = 1
@@ -22,6 +29,192 @@ class ParsingMode(Enum):
             return ParsingMode.FIRST_FOUND
 
 
+class DelimiterProfile:
+    """The delimeter and field count used by most lines in a sample of a file."""
+
+    def __init__(self, delimeter: bytes, fields: int, matched: int, sampled: int):
+        self.delimeter = delimeter
+        self.fields = fields
+        self.matched = matched
+        self.sampled = sampled
+
+    @property
+    def ratio(self):
+        return self.matched / self.sampled if self.sampled else 0
+
+    def __str__(self):
+        delim = self.delimeter.decode(errors="replace")
+        return f"delimeter {delim!r} in {self.ratio:.0%} of {self.sampled} sampled lines, {self.fields} fields"
+
+
+class LineParser:
+    """The line parsing logic on its own, without any threading or output.
+
+    Kept separate from CredentialParser so it can be pickled and sent to
+    worker processes.
+    """
+
+    def __init__(self,
+                 delimeters: List[bytes],
+                 num_values: int = 2,
+                 parse_mode: ParsingMode = ParsingMode.FIRST_FOUND,
+                 decode: bool = True):
+        self.delimeters = delimeters
+        self.num_values = num_values
+        self.parse_mode = parse_mode
+        self.decode = decode
+        """Whether to decode values to `str`. Otherwise they are left as UTF-8 `bytes`."""
+        # Finds the lowest index delimeter in a single pass. At any one index
+        # the alternatives are tried in order, so ties go to the delimeter
+        # listed first, the same as checking each delimeter in turn.
+        self.pattern = re.compile(b"|".join(re.escape(d) for d in delimeters)) if delimeters else None
+        self.profile: Optional[DelimiterProfile] = None
+        self.fast_delimeter: Optional[bytes] = None
+        self.fast_checks: List[bytes] = []
+
+    def build_profile(self, lines: Iterable[bytes]) -> Optional[DelimiterProfile]:
+        """Find the delimeter and field count most of the sampled lines use."""
+        delims = Counter()
+        fields = Counter()
+        sampled = 0
+        for val in lines:
+            val = val.strip()
+            sampled += 1
+            delim = self.get_delimeter(val)
+            if delim is not None:
+                delims[delim] += 1
+                fields[delim, val.count(delim) + 1] += 1
+        if not delims:
+            return None
+        delim, matched = delims.most_common(1)[0]
+        field_count = max((n for d, n in fields if d == delim), key=lambda n: fields[delim, n])
+        return DelimiterProfile(delim, field_count, matched, sampled)
+
+    def set_fast_delimeter(self, delimeter: Optional[bytes]):
+        """Try `delimeter` first on every line, falling back to the ParsingMode logic.
+
+        Lines are only parsed with it when the ParsingMode would have picked
+        it anyway, so the results are always the same. This only applies to
+        FIRST_FOUND, since LOWEST_INDEX already finds the delimeter in a
+        single pass.
+        """
+        if delimeter is not None and delimeter not in self.delimeters:
+            raise ValueError(f"{delimeter!r} is not one of the delimeters {self.delimeters!r}")
+        self.fast_delimeter = delimeter
+        # It is only right if none of the delimeters listed before it are in the line.
+        ind = self.delimeters.index(delimeter) if delimeter is not None else 0
+        self.fast_checks = [d for d in self.delimeters[:ind] if d != delimeter]
+
+    def get_delimeter(self, val) -> Optional[bytes]:
+        if self.parse_mode == ParsingMode.FIRST_FOUND:
+            for d in self.delimeters:
+                if d in val:
+                    return d
+        elif self.parse_mode == ParsingMode.LOWEST_INDEX and self.pattern is not None:
+            match = self.pattern.search(val)
+            return match and match.group()
+
+    def find_delimeters(self, lines: List[bytes]) -> List[Optional[bytes]]:
+        """Find the delimeter to use for each of a batch of stripped lines."""
+        if self.parse_mode == ParsingMode.LOWEST_INDEX and self.pattern is not None:
+            return [m and m.group() for m in map(self.pattern.search, lines)]
+        fast = self.fast_delimeter
+        if fast is None:
+            return list(map(self.get_delimeter, lines))
+        get_delimeter = self.get_delimeter
+        fast_checks = self.fast_checks
+        delims = []
+        for val in lines:
+            if fast in val:
+                for d in fast_checks:
+                    if d in val:
+                        delims.append(get_delimeter(val))
+                        break
+                else:
+                    delims.append(fast)
+            else:
+                delims.append(get_delimeter(val))
+        return delims
+
+    def parse_lines(self, lines: Iterable[bytes], timings: Optional[dict] = None) -> Tuple[List[list], List[Tuple[str, bytes]]]:
+        """Parse a batch of raw lines, stripping each one first.
+
+        Returns the parsed records and the lines that could not be parsed.
+        If `timings` is given, the seconds spent finding delimeters
+        ("detect") and splitting and decoding ("decode") are added to it.
+        """
+        attempt_decode = self.attempt_decode if self.decode else self.to_utf8
+        decode = self.decode
+        num_values = self.num_values
+        split_at = num_values - 1
+        records = []
+        errors = []
+        if timings is not None:
+            start = perf_counter()
+        lines = [val.strip() for val in lines]
+        delims = self.find_delimeters(lines)
+        if timings is not None:
+            detected = perf_counter()
+            timings["detect"] = detected - start
+        for val, delim in zip(lines, delims):
+            if delim is None:
+                errors.append((f"Couldn't determine delimeter.", val))
+                continue
+            vals = val.split(delim, split_at)
+            if len(vals) < num_values:
+                vals.append(b"")
+            # Most lines are plain ASCII, which is valid as is.
+            if val.isascii():
+                if decode:
+                    vals = [x.decode("ascii") for x in vals]
+            else:
+                vals = attempt_decode(vals)
+            records.append(vals)
+        if timings is not None:
+            timings["decode"] = perf_counter() - detected
+        return records, errors
+
+    def attempt_decode(self, vals):
+        encodings = ['utf8', 'latin-1']
+        for enc in encodings:
+            try:
+                utfvals = [x.decode(enc) for x in vals]
+                if enc != "utf8":
+                    utfvals = [x.encode('utf8').decode('utf8') for x in utfvals]
+                return utfvals
+            except UnicodeDecodeError:
+                pass
+        return vals
+
+    def to_utf8(self, vals):
+        """The `bytes` equivalent of attempt_decode. Values that aren't UTF-8 are read as latin-1."""
+        try:
+            for x in vals:
+                x.decode("utf8")
+            return vals
+        except UnicodeDecodeError:
+            return [x.decode("latin-1").encode("utf8") for x in vals]
+
+
+def parse_range(line_parser: LineParser, filename: str, start: int, end: int, timed: bool = False):
+    """Parse a newline aligned byte range of a file. Run in worker processes."""
+    timings = {} if timed else None
+    if timed:
+        read_start = perf_counter()
+    lines = read_range(filename, start, end)
+    if timed:
+        timings["read"] = perf_counter() - read_start
+    records, errors = line_parser.parse_lines(lines, timings)
+    return records, errors, len(lines), end - start, timings
+
+
+def parse_block(line_parser: LineParser, lines: List[bytes], byte_count: int, timed: bool = False):
+    """Parse lines read by the parent process. Run in worker processes."""
+    timings = {} if timed else None
+    records, errors = line_parser.parse_lines(lines, timings)
+    return records, errors, len(lines), byte_count, timings
+
+
 class CredentialParser(Thread):
 
     stop = False
@@ -44,32 +237,80 @@ class CredentialParser(Thread):
                                                         scope_name="Debug", 
                                                         show_count=True
                                                         ),
-                 completion_handler: Callable = None
+                 completion_handler: Callable = None,
+                 count_lines: bool = False,
+                 blocksize: int = DEFAULT_BLOCK_SIZE,
+                 workers: int = 1,
+                 ordered: bool = True,
+                 executor: Optional[Executor] = None,
+                 profile: bool = True,
+                 profile_size: int = 1 << 16,
+                 fast_delimeter: Optional[str] = None,
+                 decompress_threads: int = 2,
+                 checkpoint: Optional[Checkpoint] = None,
+                 checkpoint_interval: float = 60,
+                 resume: bool = False
                  ):
         self.filename = filename
         self.delimeters = [d.encode() for d in delimiters]
         self.num_values = num_values
         self.parse_mode = parse_mode
+        self.line_parser = LineParser(self.delimeters, num_values, parse_mode,
+                                      decode=not output_handler.accepts_bytes)
         self.output_handler = output_handler
         self.error_handler = error_handler
-        self.input_count = 0
+        self.input_count: Optional[int] = None
+        self.input_size = input_size(filename)
+        """The size of the input, or None for streams (stdin or FIFOs)."""
+        self.stream_input: Optional[InputFile] = None
         self.processed_count = 0
+        self.processed_bytes = 0
+        self.resumed_bytes = 0
+        self.offset = 0
+        """Input offset of the lines handed to the handlers so far (in the decompressed data for compressed files)."""
+        self.count_lines = count_lines
+        self.blocksize = blocksize
+        self.workers = workers
+        self.ordered = ordered
+        self.executor = executor
+        self.profile = profile
+        self.profile_size = profile_size
+        self.decompress_threads = decompress_threads
+        # A stream can only be read once, so its compression is found when it is opened.
+        self.compression = detect_compression(filename) if self.input_size is not None else None
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = datetime.now()
+        self.resume = resume
+        # Results have to come back in order to know what is safe to checkpoint.
+        self.ordered = ordered or checkpoint is not None
+        if fast_delimeter is not None:
+            if parse_mode == ParsingMode.LOWEST_INDEX:
+                logging.warning(f"{filename}: the fast delimeter is ignored with LOWEST_INDEX parsing.")
+            self.line_parser.set_fast_delimeter(fast_delimeter.encode())
         super().__init__()
         self.starttime = None
         self.endtime = None
         CredentialParser.threads.append(self)
         self.output_handler.attach()
         self.error_handler.attach()
-        self.input_count = 0
         self.completion_handler = completion_handler
         self.state = "initialized"
+        self.error: Optional[Exception] = None
+        """What made parsing fail, when `state` is "failed"."""
+        self.stats = Stats()
 
     def __str__(self):
         if self.state == "finished":
-            return f"{self.filename}: Finished in {humanize.naturaldelta(self.runtime)}"
-        if self.state == "loading" or self.state == "initialized":
+            return f"{self.filename}: Finished in {naturaldelta(self.runtime)}"
+        if self.state == "failed":
+            return f"{self.filename}: Failed after {naturaldelta(self.runtime)}: {self.error}"
+        if self.state == "initialized":
             return f"{self.filename}: loading"
-        return f"{self.filename}: {self.percent_complete:.02f}% | {self.natural_eta} left | {self.natural_runtime} elapsed"
+        if self.input_size is None:
+            return f"{self.filename}: {naturalsize(self.byte_speed)}/s | {self.processed_count} lines | {self.natural_runtime} elapsed"
+        lines = f" | {self.progress} lines" if self.input_count is not None else ""
+        return f"{self.filename}: {self.percent_complete:.02f}%{lines} | {self.natural_eta} left | {self.natural_runtime} elapsed"
 
     @property
     def runtime(self) -> timedelta:
@@ -83,31 +324,56 @@ class CredentialParser(Thread):
         return timestr(self.runtime)
 
     @property
-    def percent_complete(self):
-        return self.processed_count / self.input_count * 100
+    def percent_complete(self) -> Optional[float]:
+        if self.input_size is None:
+            return None
+        if self.input_size == 0:
+            return 100.0
+        return self.processed_bytes / self.input_size * 100
 
     @property
     def progress(self):
+        if self.input_count is None:
+            return f"{self.processed_count}"
         return f"{self.processed_count}/{self.input_count}"
 
     @property
     def speed(self):
-        return self.processed_count / self.runtime.total_seconds()
+        """Lines processed per second."""
+        seconds = self.runtime.total_seconds()
+        if seconds == 0:
+            return 0
+        return self.processed_count / seconds
+
+    @property
+    def byte_speed(self):
+        """Input bytes consumed per second."""
+        seconds = self.runtime.total_seconds()
+        if seconds == 0:
+            return 0
+        return (self.processed_bytes - self.resumed_bytes) / seconds
 
     @property
     def eta(self):
-        if self.speed == 0:
+        if self.byte_speed == 0 or self.input_size is None:
             return timedelta(seconds=0)
-        left = self.input_count - self.processed_count
-        return timedelta(seconds=left/self.speed)
+        left = self.input_size - self.processed_bytes
+        return timedelta(seconds=left/self.byte_speed)
 
     @property
     def natural_eta(self):
         return timestr(self.eta)
 
+    def stats_snapshot(self) -> dict:
+        """Counters and stage timings for this file, as plain data."""
+        snapshot = self.stats.snapshot()
+        snapshot["counters"].update(lines=self.processed_count, bytes=self.processed_bytes)
+        return dict(file=self.filename, state=self.state, input_lines=self.input_count, **snapshot)
+
     def cleanup(self):
         """Called just before exiting."""
-        self.state = "finished"
+        if self.state != "failed":
+            self.state = "finished"
         self.endtime = datetime.now()
         self.output_handler.detach()
         self.error_handler.detach()
@@ -115,56 +381,244 @@ class CredentialParser(Thread):
             self.completion_handler(self)
 
     def get_input_count(self):
-        self.input_count = len(open(self.filename, 'rb').readlines())
+        """Count the lines in the input without loading it into memory.
+
+        Progress is tracked in bytes so this is only needed when an exact
+        line total is wanted. It is run alongside parsing when `count_lines`
+        is set.
+        """
+        self.input_count = count_lines(self.filename)
 
     def run(self):
-        self.status = "loading"
-        self.get_input_count()
         self.state = "running"
         self.starttime = datetime.now()
-        for val in open(self.filename, "rb"):
-            if self.stop:
-                break
-            val = val.strip()
-            self.parse(val)
-            self.processed_count += 1
-        self.cleanup()
-    
+        try:
+            self.parse_input()
+        except Exception as e:
+            self.error = e
+            self.state = "failed"
+            logging.exception(f"{self.filename}: parsing failed: {e}")
+        finally:
+            # Handlers have to be detached even if parsing failed, or shared
+            # ones are never finished (and their threads never stopped).
+            self.cleanup()
+
+    def parse_input(self):
+        if self.resume and not self.restore_checkpoint():
+            return
+        if self.checkpoint is not None:
+            # Record where the output starts, so a crash before the first
+            # periodic checkpoint can still be rolled back.
+            self.save_checkpoint()
+        if self.input_size is None:
+            # Streams are profiled and parsed from the same input.
+            self.stream_input = InputFile(self.filename, self.blocksize, self.decompress_threads)
+            self.compression = self.stream_input.compression
+        elif self.count_lines:
+            Thread(target=self.get_input_count, daemon=True).start()
+        if self.profile and (self.parse_mode != ParsingMode.LOWEST_INDEX
+                             or logging.getLogger().isEnabledFor(logging.INFO)):
+            # LOWEST_INDEX has no fast path, so the profile would only be logged.
+            self.profile_input()
+        if self.executor is not None or self.workers > 1:
+            self.run_sharded()
+        else:
+            self.run_serial()
+        if self.checkpoint is not None:
+            self.save_checkpoint(finished=not self.stop)
+
+    def restore_checkpoint(self) -> bool:
+        """Pick up from where the last run of this file left off.
+
+        Returns False if the file was already finished.
+        """
+        entry = self.checkpoint.get(self.filename)
+        if entry is None:
+            # Anything output without a checkpoint is output again.
+            self.output_handler.restore(self.output_handler.start_state())
+            return True
+        self.processed_count = entry["processed_count"]
+        self.processed_bytes = self.resumed_bytes = entry["position"]
+        if entry["finished"]:
+            logging.info(f"{self.filename}: already finished, skipping it.")
+            return False
+        self.offset = entry["offset"]
+        self.output_handler.restore(entry["output"])
+        logging.info(f"{self.filename}: resuming from byte {self.offset} after {self.processed_count} lines.")
+        return True
+
+    def maybe_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        if (datetime.now() - self.last_checkpoint).total_seconds() >= self.checkpoint_interval:
+            self.save_checkpoint()
+
+    def save_checkpoint(self, finished: bool = False):
+        """Flush the output handler and, if that worked, record how far this file has got."""
+        self.last_checkpoint = datetime.now()
+        start = self.stats.start(sampled=False)
+        flushed = self.output_handler.flush()
+        self.stats.stop("flush", start)
+        if not flushed:
+            logging.warning(f"{self.filename}: output flush failed, not checkpointing.")
+            return
+        self.checkpoint.update(self.filename,
+                               offset=self.offset,
+                               position=self.processed_bytes,
+                               processed_count=self.processed_count,
+                               finished=finished,
+                               output=self.output_handler.checkpoint_state())
+
+    def profile_input(self):
+        """Profile the start of the file and use its main delimeter as the fast path."""
+        if self.stream_input is not None:
+            # Only what has already arrived, since a slow pipe could take
+            # a long time to fill the whole sample.
+            sample = self.stream_input.peek(1)[:self.profile_size]
+        else:
+            with InputFile(self.filename, self.profile_size) as source:
+                sample = source.peek(self.profile_size)[:self.profile_size]
+        lines = sample.split(b"\n")
+        if len(sample) == self.profile_size or self.stream_input is not None:
+            lines.pop()
+        profile = self.line_parser.build_profile(lines)
+        self.line_parser.profile = profile
+        logging.info(f"{self.filename}: {profile or 'no delimeter found'}")
+        if profile is not None and self.line_parser.fast_delimeter is None:
+            self.line_parser.set_fast_delimeter(profile.delimeter)
+
+    def open_input(self) -> InputFile:
+        if self.stream_input is not None:
+            return self.stream_input
+        return InputFile(self.filename, self.blocksize, self.decompress_threads)
+
+    def run_serial(self):
+        start = self.offset
+        with self.open_input() as source:
+            source.skip(start)
+            reader = BlockReader(source.stream, self.blocksize)
+            for lines in self.stats.timed(reader, "read"):
+                if self.stop:
+                    break
+                self.parse_lines(lines)
+                self.processed_count += len(lines)
+                self.offset = start + reader.offset
+                # Compressed progress is measured against the file on disk.
+                self.processed_bytes = source.position if self.compression else self.offset
+                self.maybe_checkpoint()
+
+    def run_sharded(self):
+        # Compressed files and streams can't be split, so they are read
+        # here and the workers only parse.
+        parse = self.parse_blocks if self.compression or self.input_size is None else self.parse_ranges
+        if self.executor is not None:
+            parse(self.executor)
+        else:
+            with ProcessPoolExecutor(self.workers) as executor:
+                parse(executor)
+
+    def parse_blocks(self, executor: Executor):
+        """Read the file here and parse each block of lines in worker processes."""
+        window = max(self.workers, 1) * 2
+        pending = deque()
+        start = self.offset
+        with self.open_input() as source:
+            source.skip(start)
+            position = source.position
+            reader = BlockReader(source.stream, self.blocksize)
+            for lines in self.stats.timed(reader, "read"):
+                if self.stop:
+                    break
+                byte_count = source.position - position
+                position = source.position
+                timed = self.stats.start() is not None
+                future = executor.submit(parse_block, self.line_parser, lines, byte_count, timed)
+                pending.append((future, start + reader.offset))
+                if len(pending) >= window:
+                    self.collect(pending)
+                # Hand on whatever is already parsed, so a slow stream's
+                # records don't wait for the window to fill.
+                while pending and pending[0][0].done():
+                    self.collect(pending)
+            while pending and not self.stop:
+                self.collect(pending)
+            for future, _ in pending:
+                future.cancel()
+
+    def parse_ranges(self, executor: Executor):
+        """Split the file into newline aligned ranges and parse them in worker processes.
+
+        At most two ranges per worker are in flight at once so memory stays
+        bounded when the output handler can't keep up with the workers.
+        """
+        window = max(self.workers, 1) * 2
+        pending = deque()
+        with open(self.filename, "rb") as f:
+            for start, end in iter_ranges(f, self.input_size, self.blocksize, self.offset):
+                if self.stop:
+                    break
+                timed = self.stats.start() is not None
+                future = executor.submit(parse_range, self.line_parser, self.filename, start, end, timed)
+                pending.append((future, end))
+                if len(pending) >= window:
+                    self.collect(pending)
+            while pending and not self.stop:
+                self.collect(pending)
+            for future, _ in pending:
+                future.cancel()
+
+    def collect(self, pending: deque):
+        """Wait for a parsed range and hand its results to the handlers.
+
+        `pending` holds pairs of futures and the input offset just past the
+        lines they parse.
+        """
+        if self.ordered:
+            done = [pending.popleft()]
+        else:
+            finished, _ = wait([future for future, _ in pending], return_when=FIRST_COMPLETED)
+            done = [item for item in pending if item[0] in finished]
+            for item in done:
+                pending.remove(item)
+        for future, offset in done:
+            start = self.stats.start()
+            records, errors, line_count, byte_count, timings = future.result()
+            self.stats.stop("wait", start)
+            if timings is not None:
+                for name, seconds in timings.items():
+                    self.stats.add_time(name, seconds)
+            self.handle_results(records, errors)
+            self.processed_count += line_count
+            self.processed_bytes += byte_count
+            if self.ordered:
+                self.offset = offset
+                self.maybe_checkpoint()
+
     def get_delimeter(self, val) -> Optional[bytes]:
-        if self.parse_mode == ParsingMode.FIRST_FOUND:
-            for d in self.delimeters:
-                if d in val:
-                    return d
-        elif self.parse_mode == ParsingMode.LOWEST_INDEX:
-            delim = None
-            delim_ind = None
-            for d in self.delimeters:
-                ind = str_index(val, d)
-                if ind is not None and (delim_ind is None or ind < delim_ind):
-                    delim = d
-                    delim_ind = ind
-            return delim
+        return self.line_parser.get_delimeter(val)
 
     def parse(self, val):
-        delim = self.get_delimeter(val)
-        if delim is None:
-            self.error_handler((f"Couldn't determine delimeter.", val))
-            return
-        
-        vals = val.split(delim)
-        vals = vals[:self.num_values - 1] + [delim.join(vals[self.num_values - 1:])]
-        vals = self.attempt_decode(vals)
-        self.output_handler(vals)
+        self.parse_lines([val])
+
+    def parse_lines(self, lines: Iterable[bytes]):
+        """Parse a batch of raw lines and send the results to the handlers."""
+        timings = {} if self.stats.start() is not None else None
+        records, errors = self.line_parser.parse_lines(lines, timings)
+        if timings is not None:
+            for name, seconds in timings.items():
+                self.stats.add_time(name, seconds)
+        self.handle_results(records, errors)
+
+    def handle_results(self, records, errors):
+        start = self.stats.start()
+        if records:
+            self.output_handler.output_batch(records)
+        if errors:
+            self.error_handler.output_batch(errors)
+        self.stats.stop("output", start)
+        self.stats.incr("records", len(records))
+        self.stats.incr("errors", len(errors))
 
     def attempt_decode(self, vals):
-        encodings = ['utf8', 'latin-1']
-        for enc in encodings:
-            try:
-                utfvals = [x.decode(enc) for x in vals]
-                if enc != "utf8":
-                    utfvals = [x.encode('utf8').decode('utf8') for x in utfvals]
-                return utfvals
-            except UnicodeDecodeError:
-                pass
-        return vals
-        
+        return self.line_parser.attempt_decode(vals)
+    
@@ -0,0 +1,252 @@
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Iterable, List, Optional, Sequence
+from CredentialParser.OutputHandler import OutputHandler
+
+HASH_MASK = (1 << 64) - 1
+
+SET_ENTRY_SIZE = 72
+"""Rough number of bytes a hash takes up in a Python set, including the int itself."""
+
+
+class SortedHashes:
+    """Sorted hashes, with where each range of their top bits starts.
+
+    Hashes are spread evenly, so that narrows every search down to a few
+    dozen hashes before bisecting.
+    """
+
+    MAX_BITS = 16
+
+    def __init__(self, hashes: Sequence[int]):
+        self.hashes = hashes
+        bits = min(max(len(hashes).bit_length() - 5, 0), SortedHashes.MAX_BITS)
+        self.shift = 64 - bits
+        self.starts = [bisect_left(hashes, b << self.shift) for b in range(1 << bits)] + [len(hashes)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def missing(self, probes: Iterable[int]) -> List[int]:
+        """The probes that aren't in here."""
+        hashes = self.hashes
+        shift = self.shift
+        starts = self.starts
+        out = []
+        for h in probes:
+            b = h >> shift
+            hi = starts[b + 1]
+            i = bisect_left(hashes, h, starts[b], hi)
+            if i == hi or hashes[i] != h:
+                out.append(h)
+        return out
+
+
+class HashRun(SortedHashes):
+    """A sorted run of hashes written to disk and memory mapped for lookups."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(memoryview(self.map).cast("Q"))
+
+    def close(self):
+        self.hashes.release()
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+def merge_into(write: Callable, big: SortedHashes, small: Sequence[int]):
+    """Write the sorted union of two sorted sets of hashes to `write`, as bytes.
+
+    `small` is an array or memoryview of hashes. The merge goes through
+    `big`'s ranges one at a time, copying ranges with nothing new in them
+    as they are and sorting the rest.
+    """
+    hashes = memoryview(big.hashes)
+    shift = big.shift
+    starts = big.starts
+    small_lo = 0
+    for b in range(len(starts) - 1):
+        lo, hi = starts[b], starts[b + 1]
+        small_hi = bisect_left(small, (b + 1) << shift, small_lo)
+        if small_hi == small_lo:
+            write(hashes[lo:hi].cast("B"))
+        else:
+            write(array("Q", sorted(hashes[lo:hi].tolist() + small[small_lo:small_hi].tolist())).tobytes())
+        small_lo = small_hi
+    hashes.release()
+
+
+class Deduplicator:
+    """Remembers which records have been seen, using a bounded amount of memory.
+
+    Each record is reduced to a 64 bit hash. New hashes go into a set, which
+    is merged into one sorted array of fixed width hashes whenever it fills
+    up. Once the array uses more than its share of `memory_limit` it is
+    spilled to a sorted run file on disk, which is memory mapped. Runs are
+    merged whenever the newest is at least half the size of the one before
+    it, or there are more than `max_runs` of them, so there are only ever a
+    few.
+
+    A batch is checked against the set in one go, and only the hashes
+    that are new to it are looked up in the (few) sorted arrays. Hashing
+    is done before taking the lock.
+
+    Hashes come from hash(), so they are only stable within one process.
+    That is fine since every parser hands its records back to the main
+    process.
+    """
+
+    def __init__(self,
+                 memory_limit: int = 512 << 20,
+                 spill_dir: Optional[str] = None,
+                 max_runs: int = 8):
+        self.memory_limit = memory_limit
+        self.max_runs = max_runs
+        self.recent_limit = max(memory_limit // 4 // SET_ENTRY_SIZE, 1024)
+        # Merging makes a new array alongside the old one, so each only gets half.
+        self.frozen_limit = (memory_limit - self.recent_limit * SET_ENTRY_SIZE) // 2
+        self.recent = set()
+        self.frozen = SortedHashes(array("Q"))
+        self.runs: List[HashRun] = []
+        self.spill_dir = tempfile.mkdtemp(prefix="credparser-dedup-", dir=spill_dir)
+        self.spill_count = 0
+        self.lock = Lock()
+        self.seen_count = 0
+        self.duplicates = 0
+
+    def __str__(self):
+        return f"{self.duplicates} duplicates removed from {self.seen_count} records"
+
+    @staticmethod
+    def key(params) -> int:
+        if params and isinstance(params[0], bytes):
+            return hash(b"\0".join(params)) & HASH_MASK
+        return hash("\0".join(params)) & HASH_MASK
+
+    @staticmethod
+    def keys(records: Sequence) -> List[int]:
+        """key() of every record, which are all `bytes` or all `str`."""
+        if not records or not records[0]:
+            return [Deduplicator.key(params) for params in records]
+        join = (b"\0" if isinstance(records[0][0], bytes) else "\0").join
+        return [hash(join(params)) & HASH_MASK for params in records]
+
+    def contains(self, h: int) -> bool:
+        return not self.unseen({h})
+
+    def unseen(self, candidates: set) -> set:
+        """The hashes out of `candidates` that haven't been seen before."""
+        candidates = candidates - self.recent
+        if not candidates:
+            return candidates
+        for hashes in [self.frozen] + self.runs:
+            if candidates and len(hashes):
+                candidates = hashes.missing(candidates)
+        return set(candidates)
+
+    def filter(self, records: Sequence) -> list:
+        """Return the records that haven't been seen before, and remember them.
+
+        Records keep their order, and only the first of several equal
+        records in the batch is kept.
+        """
+        hashes = self.keys(records)
+        with self.lock:
+            fresh = self.unseen(set(hashes))
+            self.recent.update(fresh)
+            self.seen_count += len(records)
+            # discard() returns None, so each fresh hash lets its first record through.
+            unique = [params for params, h in zip(records, hashes) if h in fresh and not fresh.discard(h)]
+            self.duplicates += len(records) - len(unique)
+            if len(self.recent) >= self.recent_limit:
+                self.freeze()
+        return unique
+
+    def freeze(self):
+        merged = array("Q")
+        merge_into(merged.frombytes, self.frozen, array("Q", sorted(self.recent)))
+        self.frozen = SortedHashes(merged)
+        self.recent = set()
+        if len(self.frozen) * 8 > self.frozen_limit:
+            self.spill()
+
+    def new_run_path(self) -> str:
+        self.spill_count += 1
+        return os.path.join(self.spill_dir, f"run{self.spill_count}.bin")
+
+    def spill(self):
+        logging.debug(f"Spilling {len(self.frozen)} hashes to disk")
+        path = self.new_run_path()
+        with open(path, "wb") as f:
+            self.frozen.hashes.tofile(f)
+        self.frozen = SortedHashes(array("Q"))
+        self.runs.append(HashRun(path))
+        while len(self.runs) > 1 and (len(self.runs) > self.max_runs or len(self.runs[-2]) <= 2 * len(self.runs[-1])):
+            self.merge_last_runs()
+
+    def merge_last_runs(self):
+        """Merge the two newest (and smallest) runs into one."""
+        big, small = self.runs[-2], self.runs[-1]
+        logging.debug(f"Merging dedup runs of {len(big)} and {len(small)} hashes")
+        path = self.new_run_path()
+        with open(path, "wb") as f:
+            merge_into(f.write, big, small.hashes)
+        big.close()
+        small.close()
+        self.runs[-2:] = [HashRun(path)]
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class DedupHandler(OutputHandler):
+    """Drops records a shared Deduplicator has already seen and passes the rest on to `handler`."""
+
+    def __init__(self, handler: OutputHandler, deduplicator: Deduplicator):
+        self.handler = handler
+        self.deduplicator = deduplicator
+        self.accepts_bytes = handler.accepts_bytes
+        super().__init__()
+
+    def attach(self):
+        super().attach()
+        self.handler.attach()
+
+    def detach(self):
+        super().detach()
+        self.handler.detach()
+
+    def flush(self) -> bool:
+        return self.handler.flush()
+
+    def checkpoint_state(self) -> dict:
+        return self.handler.checkpoint_state()
+
+    def restore(self, state: dict):
+        self.handler.restore(state)
+
+    def start_state(self) -> dict:
+        return self.handler.start_state()
+
+    def do_output(self, params):
+        if self.deduplicator.filter([params]):
+            self.handler.output(params)
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        unique = self.deduplicator.filter(records)
+        if unique:
+            self.handler.output_batch(unique)
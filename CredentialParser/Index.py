@@ -0,0 +1,324 @@
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+from bisect import bisect_left
+from typing import Callable, Iterable, Iterator, List, Optional
+from CredentialParser.OutputHandler import OutputHandler
+
+MAGIC = b"CPINDEX1"
+FOOTER = struct.Struct("<QQQ8s")
+"""Offsets of the block entries, the first keys and the metadata, then the magic."""
+BLOCK_ENTRY = struct.Struct("<QIIQI")
+"""Offset, compressed length and record count of a block, and the offset and length of its first key."""
+
+DEFAULT_INDEX_BLOCK_SIZE = 64 << 10
+
+
+ESCAPED = re.compile(rb"[\x00-\x1f\\]")
+UNESCAPE = re.compile(rb"\\(\\|x[0-9a-f]{2})")
+
+
+def escape_byte(match) -> bytes:
+    c = match.group()
+    return b"\\\\" if c == b"\\" else b"\\x%02x" % ord(c)
+
+
+def unescape_byte(match) -> bytes:
+    code = match.group(1)
+    return b"\\" if code == b"\\" else bytes([int(code[1:], 16)])
+
+
+def escape(value: bytes) -> bytes:
+    """Escape backslashes and control characters, including the tabs and newlines used as separators.
+
+    Every escaped byte sorts after the tab separating a record's key from
+    its fields, so sorting record lines sorts them by key.
+    """
+    if ESCAPED.search(value) is None:
+        return value
+    return ESCAPED.sub(escape_byte, value)
+
+
+def unescape(value: bytes) -> bytes:
+    if b"\\" not in value:
+        return value
+    return UNESCAPE.sub(unescape_byte, value)
+
+
+def as_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else value.encode()
+
+
+def key_function(key: str) -> Callable[[list], bytes]:
+    """Get the function that picks the index key of a record.
+
+    `key` is either a field number or "domain", the domain of field 0.
+    Keys are lowercased so lookups aren't case sensitive.
+    """
+    if key == "domain":
+        def domain(params):
+            value = as_bytes(params[0])
+            return value.rpartition(b"@")[2].lower() if b"@" in value else b""
+        return domain
+    field = int(key)
+    return lambda params: as_bytes(params[field]).lower()
+
+
+def encode_record(key: bytes, params) -> bytes:
+    """A record as one line: the key then every field, tab separated.
+
+    Sorting these lines sorts the records by key.
+    """
+    return b"\t".join([escape(key)] + [escape(as_bytes(v)) for v in params]) + b"\n"
+
+
+class IndexWriter:
+    """Writes sorted record lines to an index file in compressed blocks."""
+
+    def __init__(self, path: str, block_size: int = DEFAULT_INDEX_BLOCK_SIZE):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.block_size = block_size
+        self.block: List[bytes] = []
+        self.block_bytes = 0
+        self.entries: List[tuple] = []
+        self.keys: List[bytes] = []
+        self.keys_size = 0
+        self.records = 0
+
+    def write(self, line: bytes):
+        self.block.append(line)
+        self.block_bytes += len(line)
+        self.records += 1
+        if self.block_bytes >= self.block_size:
+            self.write_block()
+
+    def write_block(self):
+        if not self.block:
+            return
+        first_key = self.block[0].split(b"\t", 1)[0]
+        data = zlib.compress(b"".join(self.block), 6)
+        self.entries.append((self.file.tell(), len(data), len(self.block), self.keys_size, len(first_key)))
+        self.keys.append(first_key)
+        self.keys_size += len(first_key)
+        self.file.write(data)
+        self.block = []
+        self.block_bytes = 0
+
+    def close(self, metadata: dict):
+        self.write_block()
+        entries_offset = self.file.tell()
+        for entry in self.entries:
+            self.file.write(BLOCK_ENTRY.pack(*entry))
+        keys_offset = self.file.tell()
+        self.file.write(b"".join(self.keys))
+        meta_offset = self.file.tell()
+        metadata = dict(metadata, records=self.records, blocks=len(self.entries))
+        self.file.write(json.dumps(metadata).encode())
+        self.file.write(FOOTER.pack(entries_offset, keys_offset, meta_offset, MAGIC))
+        self.file.close()
+
+
+class BlockKeys:
+    """The first key of every block, read straight from the memory mapped index as needed."""
+
+    def __init__(self, reader: 'IndexReader'):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.block_count
+
+    def __getitem__(self, i: int) -> bytes:
+        _, _, _, key_offset, key_length = self.reader.entry(i)
+        start = self.reader.keys_offset + key_offset
+        return self.reader.map[start:start + key_length]
+
+
+class IndexReader:
+    """Looks records up in an index file, which is memory mapped.
+
+    The fixed size block entries and the first key of every block make a
+    sparse index that is binary searched in place, so opening even a huge
+    index is instant. Only the blocks that can hold matches are
+    decompressed.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(MAGIC) + FOOTER.size or self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a credential index")
+        self.entries_offset, self.keys_offset, meta_offset, magic = FOOTER.unpack(self.map[-FOOTER.size:])
+        if magic != MAGIC:
+            raise ValueError(f"{path} is incomplete")
+        self.metadata = json.loads(self.map[meta_offset:len(self.map) - FOOTER.size])
+        self.block_count = (self.keys_offset - self.entries_offset) // BLOCK_ENTRY.size
+        self.first_keys = BlockKeys(self)
+
+    def entry(self, i: int) -> tuple:
+        return BLOCK_ENTRY.unpack_from(self.map, self.entries_offset + i * BLOCK_ENTRY.size)
+
+    def __len__(self):
+        return self.metadata["records"]
+
+    def read_block(self, i: int) -> List[bytes]:
+        offset, length, _, _, _ = self.entry(i)
+        return zlib.decompress(self.map[offset:offset + length]).splitlines(keepends=True)
+
+    def iter_lines(self) -> Iterator[bytes]:
+        """Every record line, in order."""
+        for i in range(self.block_count):
+            yield from self.read_block(i)
+
+    def lookup(self, key, prefix: bool = False, limit: Optional[int] = None) -> Iterator[List[bytes]]:
+        """Find the records with a key equal to (or starting with, if `prefix`) `key`."""
+        target = escape(as_bytes(key).lower())
+        # Records with the key can start at the end of the block before the
+        # first block whose first key is >= the target.
+        start = max(bisect_left(self.first_keys, target) - 1, 0)
+        found = 0
+        for i in range(start, self.block_count):
+            for line in self.read_block(i):
+                k, _, rest = line.rstrip(b"\n").partition(b"\t")
+                if k < target:
+                    continue
+                if k == target or (prefix and k.startswith(target)):
+                    yield [unescape(v) for v in rest.split(b"\t")]
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return
+                else:
+                    return
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_run(lines: Iterable[bytes], directory: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+        for line in lines:
+            f.write(line)
+    return path
+
+
+def iter_run(path: str) -> Iterator[bytes]:
+    with open(path, "rb", buffering=1 << 20) as f:
+        yield from f
+
+
+def unique(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """Drop repeats of the same line from a sorted stream."""
+    last = None
+    for line in lines:
+        if line != last:
+            yield line
+            last = line
+
+
+class IndexHandler(OutputHandler):
+    """Builds a sorted, block compressed index of records, keyed on one field.
+
+    Records are buffered up to `memory_limit` bytes, then sorted and
+    spilled to a run file, so input far larger than memory can be
+    indexed. When the handler is done the runs are merged (at most
+    `max_fanin` at a time) into the index. If the index already exists its
+    records are merged in too, so new files can be added to it. Identical
+    records are only kept once.
+    """
+
+    accepts_bytes = True
+
+    def __init__(self,
+                 path: str,
+                 key: str = "0",
+                 memory_limit: int = 256 << 20,
+                 block_size: int = DEFAULT_INDEX_BLOCK_SIZE,
+                 spill_dir: Optional[str] = None,
+                 max_fanin: int = 64):
+        self.path = path
+        self.key = key
+        self.key_function = key_function(key)
+        self.memory_limit = memory_limit
+        self.block_size = block_size
+        self.max_fanin = max_fanin
+        self.spill_dir = tempfile.mkdtemp(prefix="credparser-index-", dir=spill_dir)
+        self.buffer: List[bytes] = []
+        self.buffer_bytes = 0
+        self.runs: List[str] = []
+        if os.path.exists(path):
+            with IndexReader(path) as existing:
+                if existing.metadata.get("key") != key:
+                    raise ValueError(f"{path} is keyed on {existing.metadata.get('key')!r}, not {key!r}")
+        super().__init__()
+
+    def do_output(self, params):
+        self.add([params])
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        self.add(records)
+
+    def add(self, records):
+        get_key = self.key_function
+        lines = [encode_record(get_key(params), params) for params in records]
+        self.buffer.extend(lines)
+        # Roughly what each line costs in memory, including the list slot.
+        self.buffer_bytes += sum(map(len, lines)) + 41 * len(lines)
+        if self.buffer_bytes >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        if not self.buffer:
+            return
+        logging.debug(f"Spilling {len(self.buffer)} index records to disk")
+        self.buffer.sort()
+        self.runs.append(write_run(unique(self.buffer), self.spill_dir))
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def merge_runs(self):
+        """Merge runs until there are few enough to merge into the index in one pass."""
+        while len(self.runs) > self.max_fanin:
+            group, self.runs = self.runs[:self.max_fanin], self.runs[self.max_fanin:]
+            merged = write_run(unique(heapq.merge(*[iter_run(run) for run in group])), self.spill_dir)
+            for run in group:
+                os.remove(run)
+            self.runs.append(merged)
+
+    def build(self):
+        self.spill()
+        self.merge_runs()
+        sources = [iter_run(run) for run in self.runs]
+        existing = IndexReader(self.path) if os.path.exists(self.path) else None
+        if existing is not None:
+            sources.append(existing.iter_lines())
+        tmp = f"{self.path}.tmp"
+        writer = IndexWriter(tmp, self.block_size)
+        for line in unique(heapq.merge(*sources)):
+            writer.write(line)
+        writer.close(dict(key=self.key))
+        if existing is not None:
+            existing.close()
+        os.replace(tmp, self.path)
+        logging.info(f"Wrote {writer.records} records in {len(writer.entries)} blocks to {self.path}")
+
+    def done(self):
+        try:
+            self.build()
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -1,17 +1,118 @@
 import logging
-import psycopg2
-from collections import deque
-from itertools import islice
-from threading import Lock
-from typing import Deque, List, Optional
+import os
+import time
+from queue import Queue
+from threading import Barrier, Lock
+from typing import Callable, Optional, Tuple, Type
 import logging
+from collections import Counter
+from CredentialParser.Stats import Stats
+
+POSTGRES_NAMES = ["COPY_ESCAPES", "ConnectionPool", "PostgresHandler", "PostgresWriter", "copy_escape"]
+"""What used to be defined here and now lives in CredentialParser.Postgres."""
+
+
+def __getattr__(name):
+    # Postgres output is only imported when it's used, since loading
+    # psycopg2 slows down every run that doesn't need it.
+    if name in POSTGRES_NAMES:
+        from CredentialParser import Postgres
+        return getattr(Postgres, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+STOP_DRAINING = object()
+"""Put on a queue to make drain_queue() return."""
+
+
+class FlushRequest:
+    """Asks every thread draining a queue with drain_queue() to flush, and waits for them to finish."""
+
+    def __init__(self, writers: int):
+        self.barrier = Barrier(writers + 1)
+        self.failed = False
+
+    def report(self, failed: bool):
+        if failed:
+            self.failed = True
+        self.barrier.wait()
+
+    def wait(self) -> bool:
+        """Returns whether every writer flushed without anything failing since the last flush."""
+        self.barrier.wait()
+        return not self.failed
+
+
+def drain_queue(queue: Queue, write: Callable[[list], None], flush: Callable[[], bool], name: str):
+    """Pass batches from `queue` to `write`, until STOP_DRAINING is taken off it.
+
+    A FlushRequest calls `flush`. Batches that failed to write are lost,
+    so their failure is kept until a FlushRequest has reported it.
+    """
+    failed = False
+    while True:
+        item = queue.get()
+        try:
+            if item is STOP_DRAINING:
+                break
+            if isinstance(item, FlushRequest):
+                failed = not flush() or failed
+            else:
+                write(item)
+        except Exception as e:
+            logging.exception(f"{name} failed: {e}")
+            failed = True
+        finally:
+            if isinstance(item, FlushRequest):
+                item.report(failed)
+                failed = False
+            queue.task_done()
+
+
+def write_isolated(records: list, send: Callable[[list], None], savepoint: Callable[[], None],
+                   release: Callable[[], None], rollback: Callable[[], None],
+                   errors: Tuple[Type[Exception], ...], handler: 'OutputHandler') -> int:
+    """Send rows, retrying halves of a failing batch until the bad rows are found.
+
+    Each attempt runs inside a savepoint so a failure only undoes that
+    attempt and everything else stays in the transaction to be committed
+    together. Rows that fail on their own with one of `errors` go to the
+    handler's `rejects_handler`. Returns the number of rejected rows.
+    """
+    stats = handler.stats
+
+    def attempt(batch: list) -> int:
+        try:
+            savepoint()
+            start = stats.start()
+            send(batch)
+            stats.stop("db_send", start)
+            release()
+            return 0
+        except errors as e:
+            rollback()
+            if len(batch) == 1:
+                logging.debug(f"Rejected row {batch[0]}: {e}")
+                handler.rejects_handler.output_batch(batch)
+                stats.incr("rejected")
+                return 1
+            logging.debug(f"Caught Error on batch of {len(batch)} rows, splitting it: {e}")
+        mid = len(batch) // 2
+        return attempt(batch[:mid]) + attempt(batch[mid:])
+
+    return attempt(records)
+
 
 class OutputHandler:
 
-    def __init__(self, lock=Lock()):
+    accepts_bytes = False
+    """Whether records can be passed as UTF-8 `bytes` instead of `str` values."""
+
+    def __init__(self, lock=None):
         self.output_count = 0
-        self.lock = lock
+        self.lock = lock if lock is not None else Lock()
         self.attached_count = 0
+        self.stats = Stats()
 
     def __call__(self, params):
         self.output(params)
@@ -31,6 +132,28 @@ class OutputHandler:
         self.do_output(params)
         self.lock.release()
 
+    def output_batch(self, records):
+        """Output a list of records while only taking the lock once.
+
+        Do not override this unless you implement thread safety yourself.
+        """
+        if type(self).output is not OutputHandler.output:
+            # Handlers with their own output() do their own locking.
+            for params in records:
+                self.output(params)
+            return
+        stats = self.stats
+        start = stats.start()
+        with self.lock:
+            if start is None:
+                self.do_output_batch(records)
+            else:
+                acquired = time.perf_counter()
+                stats.add_time("lock_wait", acquired - start)
+                self.do_output_batch(records)
+                stats.add_time("write", time.perf_counter() - acquired)
+        stats.incr("records", len(records))
+
     def do_output(self, params):
         """Handle the actual output. 
         
@@ -38,6 +161,37 @@ class OutputHandler:
         """
         print(f"[Debug] Not Outputting {params}")
 
+    def do_output_batch(self, records):
+        """Handle a batch of records.
+
+        Override this to handle a whole batch at once. Overrides are
+        responsible for advancing `output_count`. By default each record is
+        passed to `do_output`.
+        """
+        for params in records:
+            self.output_count += 1
+            self.do_output(params)
+
+    def flush(self) -> bool:
+        """Make everything output so far durable. Returns whether that worked.
+
+        Used before checkpointing, so a resumed run doesn't lose or repeat
+        records.
+        """
+        return True
+
+    def checkpoint_state(self) -> dict:
+        """Anything needed to roll the output back to the last flush() when resuming."""
+        return {}
+
+    def restore(self, state: dict):
+        """Roll the output back to a state from checkpoint_state()."""
+        pass
+
+    def start_state(self) -> dict:
+        """The checkpoint_state() from before anything was output, to roll back to when resuming a file that has no checkpoint."""
+        return {}
+
     def done(self):
         """Called just before exiting"""
         pass
@@ -72,6 +226,13 @@ class LoggingHandler(OutputHandler):
         output += self.output_formatter(formatted_args)
         logging.log(self.log_level, output)
 
+    def do_output_batch(self, records):
+        # Skip formatting entirely when nothing would be logged.
+        if not logging.getLogger().isEnabledFor(self.log_level):
+            self.output_count += len(records)
+            return
+        super().do_output_batch(records)
+
 
 
 
@@ -94,7 +255,7 @@ class PrintHandler(OutputHandler):
         self.print_kwargs = print_kwargs
         super().__init__(PrintHandler.lock)
 
-    def do_output(self, args):
+    def format_output(self, args):
         formatted_args = [self.arg_formatter(arg) for arg in args]
         output = ""
         if self.show_count or self.scope_name is not None:
@@ -107,122 +268,191 @@ class PrintHandler(OutputHandler):
             output += f"[{header}] "
 
         output += self.output_formatter(formatted_args)
-        print(output, *self.print_args, **self.print_kwargs)
+        return output
+
+    def do_output(self, args):
+        print(self.format_output(args), *self.print_args, **self.print_kwargs)
+
+    def do_output_batch(self, records):
+        if self.print_args:
+            super().do_output_batch(records)
+            return
+        outputs = []
+        for args in records:
+            self.output_count += 1
+            outputs.append(self.format_output(args))
+        # A single print call writes the same text as one call per record.
+        end = self.print_kwargs.get("end", "\n")
+        print(end.join(outputs), **self.print_kwargs)
 
 
 class FileHandler(OutputHandler):
+    """Writes delimited records to a UTF-8 file.
+
+    Values may be `bytes` (written as is) or `str`. `filename` may also be
+    a file descriptor. Output goes through a
+    `buffer_size` write buffer, which is flushed to the OS once
+    `flush_bytes` have been written or `flush_interval` seconds have
+    passed since the last flush (either can be None to only flush when the
+    buffer fills). `fsync` controls when data is forced to disk: "never",
+    on "close", or on every "flush". flush() itself, used for
+    checkpoints, always syncs. With `keep_existing` the file is opened
+    for appending whatever `filemode` is, so a resumed run can roll it
+    back to its checkpoint instead of losing it.
+    """
+
+    accepts_bytes = True
+
+    FSYNC_POLICIES = ["never", "close", "flush"]
+
     def __init__(self,
                  filename,
                  filemode="a",
-                 delimiter="\t"):
-        self.file = open(filename, filemode)
-        self.delimiter = delimiter
+                 delimiter="\t",
+                 buffer_size: int = 1 << 20,
+                 flush_bytes: Optional[int] = None,
+                 flush_interval: Optional[float] = None,
+                 fsync: str = "never",
+                 keep_existing: bool = False):
+        if fsync not in FileHandler.FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FileHandler.FSYNC_POLICIES}, not {fsync!r}")
+        # A file descriptor (like 1 for stdout) is written to but left open.
+        mode = "a" if keep_existing else filemode
+        self.file = open(filename, f"{mode}b", buffering=buffer_size, closefd=not isinstance(filename, int))
+        self.start_position = 0 if filemode == "w" else self.file.tell()
+        self.delimiter = delimiter.encode()
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
         super().__init__()
 
+    def format_line(self, params) -> bytes:
+        vals = [v if isinstance(v, bytes) else v.encode() for v in params]
+        return self.delimiter.join(vals) + b"\n"
+
     def do_output(self, params):
-        line = self.delimiter.join(params)
-        self.file.write(f"{line}\n")
+        self.write(self.format_line(params))
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        join = self.delimiter.join
+        try:
+            data = b"\n".join([join(params) for params in records]) + b"\n"
+        except TypeError:
+            data = b"".join([self.format_line(params) for params in records])
+        self.write(data)
+
+    def write(self, data: bytes):
+        """Write already formatted bytes, flushing if the flush policy says to."""
+        self.file.write(data)
+        self.unflushed += len(data)
+        if self.flush_bytes is not None and self.unflushed >= self.flush_bytes:
+            self.flush_buffer()
+        elif self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush_buffer()
+
+    def flush_buffer(self, sync: bool = False):
+        self.file.flush()
+        if sync or self.fsync == "flush":
+            os.fsync(self.file.fileno())
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self) -> bool:
+        with self.lock:
+            self.flush_buffer(sync=True)
+        return True
+
+    def checkpoint_state(self) -> dict:
+        return {"position": self.file.tell()}
+
+    def restore(self, state: dict):
+        # Anything written after the checkpoint is written again on resume.
+        with self.lock:
+            self.file.truncate(state["position"])
+            # truncate() leaves the position where it was, which the next
+            # checkpoint would record.
+            self.file.seek(state["position"])
+
+    def start_state(self) -> dict:
+        return {"position": self.start_position}
 
     def done(self):
+        if self.fsync != "never":
+            self.flush_buffer(sync=True)
         self.file.close()
 
-class PostgresHandler(OutputHandler):
 
-    def __init__(self,
-                 username: str,
-                 password: str,
-                 database: str,
-                 table: str,
-                 host: str = "localhost",
-                 port: int = 5432,
-                 querytemplate: str = "INSERT INTO {table} ({fields}) VALUES ({types})",
-                 fieldnames: List[str] = ["username", "password"],
-                 fieldtypes: Optional[List[str]] = None,
-                 autocommit: bool = False,
-                 commitfreq: int = None):
-
-        self.conn = psycopg2.connect(user=username, 
-                                        password=password, 
-                                        dbname=database,
-                                        host=host, 
-                                        port=port)
-        self.conn.set_session(autocommit=autocommit)
-        self.autocommit = autocommit
-        self.cursor = self.conn.cursor()
-        self.table = table
-        self.querytemplate = querytemplate
-        self.fieldnames = fieldnames
-        self.fieldtypes = fieldtypes if fieldtypes is not None else ["%s"] * len(self.fieldnames)
-        self.commitfreq = commitfreq
-        self.uncommitted = 0
-        self.history = deque([], (self.commitfreq or 1000) * 2)
-        self.prep_query()
-        super().__init__()
+class RejectsHandler(OutputHandler):
+    """Collects lines that couldn't be parsed, as (reason, line) records.
 
-    def prep_query(self):
-        fields = ",".join(self.fieldnames)
-        types = ",".join(self.fieldtypes)
-        self.query = self.querytemplate.format(table=self.table, 
-                                          fields=fields, 
-                                          types=types)
+    The lines are appended to `filename` (if given) through a
+    `buffer_size` buffer, as the parser saw them: with surrounding
+    whitespace, including any carriage return, stripped. Rejects are
+    counted by reason, and at most `sample_count` of them are logged every
+    `sample_interval` seconds, so dirty input doesn't spend its time
+    formatting log messages.
+    """
 
+    accepts_bytes = True
 
-    def do_output(self, params):
-        try:
-            self.cursor.execute(self.query, params)
-            if not self.autocommit:
-                self.history.append(params)
-        except psycopg2.Error  as e:
-            logging.debug(f"Caught Error: {e}")
-            if not self.autocommit:
-                self.retry(self.uncommitted)
-            return
-        except UnicodeDecodeError as e:
-            print(f"{params}")
-            logging.error(e)
+    def __init__(self,
+                 filename: Optional[str] = None,
+                 buffer_size: int = 1 << 20,
+                 sample_count: int = 5,
+                 sample_interval: float = 10,
+                 log_level=logging.DEBUG):
+        self.file = open(filename, "ab", buffering=buffer_size) if filename is not None else None
+        self.reasons = Counter()
+        self.sample_count = sample_count
+        self.sample_interval = sample_interval
+        self.log_level = log_level
+        self.window_start = time.monotonic()
+        self.window_logged = 0
+        super().__init__()
 
-        self.uncommitted += 1
-        self.check_commit()
-    
-    def do_commit(self):
-        logging.debug(f"Committing Transaction")
-        try:
-            self.conn.commit()
-        except psycopg2.Error as e:
-            logging.debug(f"Caught Error on Commit: {e}")
+    def __str__(self):
+        reasons = ", ".join(f"{count} {reason!r}" for reason, count in self.reasons.most_common())
+        return f"{self.output_count} rejected lines" + (f" ({reasons})" if reasons else "")
 
-    def check_commit(self):
-        if self.autocommit:
+    def do_output(self, params):
+        self.reject([params])
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        self.reject(records)
+
+    def reject(self, records):
+        reasons = [reason for reason, _ in records]
+        if len(set(reasons)) == 1:
+            self.reasons[reasons[0]] += len(reasons)
+        else:
+            self.reasons.update(reasons)
+        if self.file is not None:
+            self.file.write(b"\n".join([line for _, line in records]) + b"\n")
+        self.log_sample(records)
+
+    def log_sample(self, records):
+        now = time.monotonic()
+        if now - self.window_start >= self.sample_interval:
+            self.window_start = now
+            self.window_logged = 0
+        room = self.sample_count - self.window_logged
+        if room <= 0 or not logging.getLogger().isEnabledFor(self.log_level):
             return
-        if self.commitfreq is not None and self.uncommitted >= self.commitfreq:
-            self.do_commit()
-            self.uncommitted = 0
-    
-    def rollback(self):
-        logging.debug("Rolling Back Changes")
-        self.conn.rollback()
+        for reason, line in records[:room]:
+            logging.log(self.log_level, f"[Rejected] {reason} {line!r}")
+        self.window_logged += min(room, len(records))
 
-    def retry(self, lastn):
-        if lastn == 0:
-            return
-        self.rollback()
-        logging.info(f"Retrying last {lastn} queries.")
-        last_hist = islice(self.history, len(self.history) - lastn, len(self.history))
-        for params in last_hist:
-            try:
-                self.cursor.execute(self.query, params)
-                self.conn.commit()
-                self.uncommitted = 0
-            except psycopg2.Error as e:
-                logging.debug(f"Failed retry of params: {params}. Not Retrying.\n{e}")
-            
+    def flush(self) -> bool:
+        if self.file is not None:
+            with self.lock:
+                self.file.flush()
+        return True
 
-        
     def done(self):
-        logging.info(f"Exiting Postgres Handler")
-        self.do_commit()
-        self.cursor.close()
-        self.conn.close()
-
-
-
+        if self.file is not None:
+            self.file.close()
+        logging.info(str(self))
@@ -0,0 +1,103 @@
+import zlib
+from queue import Queue
+from threading import Thread
+from typing import Callable, Dict, List, Union
+from CredentialParser.OutputHandler import FlushRequest, OutputHandler, STOP_DRAINING, drain_queue
+
+
+def as_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else value.encode()
+
+
+def partition_by_hash(params, partitions: int) -> int:
+    """Partition on a CRC32 of the first field (the username)."""
+    return zlib.crc32(as_bytes(params[0])) % partitions
+
+
+def partition_by_domain(params, partitions: int) -> int:
+    """Partition on the domain of the first field, so every address at a domain ends up together.
+
+    Values without an @ all go to the same partition.
+    """
+    value = as_bytes(params[0])
+    domain = value.rpartition(b"@")[2] if b"@" in value else b""
+    return zlib.crc32(domain.lower()) % partitions
+
+
+PARTITION_KEYS: Dict[str, Callable[[list, int], int]] = {
+    "hash": partition_by_hash,
+    "domain": partition_by_domain,
+}
+
+
+class PartitionedHandler(OutputHandler):
+    """Splits records between several output handlers by a partition key.
+
+    `key` is one of PARTITION_KEYS or a function of a record and the
+    number of sinks that returns the index of the sink to use. Each sink
+    gets its own queue and writer thread, so partitions are written and
+    flushed in parallel. Parsers block once `queue_size` batches are
+    waiting for a sink.
+    """
+
+    def __init__(self,
+                 sinks: List[OutputHandler],
+                 key: Union[str, Callable[[list, int], int]] = "hash",
+                 queue_size: int = 16):
+        self.sinks = sinks
+        self.key = PARTITION_KEYS[key] if isinstance(key, str) else key
+        self.accepts_bytes = all(sink.accepts_bytes for sink in sinks)
+        self.queues = [Queue(queue_size) for _ in sinks]
+        self.writers = []
+        for i, sink in enumerate(sinks):
+            sink.attach()
+            writer = Thread(target=self.drain, args=(i,), daemon=True)
+            writer.start()
+            self.writers.append(writer)
+        super().__init__()
+
+    def drain(self, index: int):
+        sink = self.sinks[index]
+        drain_queue(self.queues[index], sink.output_batch, sink.flush, f"Partition {index}")
+        sink.detach()
+
+    def do_output(self, params):
+        self.route([params])
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        self.route(records)
+
+    def route(self, records):
+        partitions = len(self.sinks)
+        key = self.key
+        parts = [[] for _ in range(partitions)]
+        for params in records:
+            parts[key(params, partitions)].append(params)
+        for queue, part in zip(self.queues, parts):
+            if part:
+                queue.put(part)
+
+    def flush(self) -> bool:
+        """Flush every sink, in parallel. Returns whether they all succeeded."""
+        with self.lock:
+            request = FlushRequest(len(self.sinks))
+            for queue in self.queues:
+                queue.put(request)
+            return request.wait()
+
+    def checkpoint_state(self) -> dict:
+        return {"sinks": [sink.checkpoint_state() for sink in self.sinks]}
+
+    def restore(self, state: dict):
+        for sink, sink_state in zip(self.sinks, state["sinks"]):
+            sink.restore(sink_state)
+
+    def start_state(self) -> dict:
+        return {"sinks": [sink.start_state() for sink in self.sinks]}
+
+    def done(self):
+        for queue in self.queues:
+            queue.put(STOP_DRAINING)
+        for writer in self.writers:
+            writer.join()
@@ -0,0 +1,312 @@
+import logging
+import psycopg2
+from psycopg2.extras import execute_batch
+from io import StringIO
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+from CredentialParser.OutputHandler import FlushRequest, LoggingHandler, OutputHandler, STOP_DRAINING, drain_queue, write_isolated
+
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_escape(value: str) -> str:
+    """Escape a value for the text format used by COPY."""
+    return value.translate(COPY_ESCAPES)
+
+
+class ConnectionPool:
+    """A thread safe pool of DB-API connections, opened as they are needed."""
+
+    def __init__(self, connect: Callable[[], Any], maxsize: int = 4):
+        self.connect = connect
+        self.maxsize = maxsize
+        self.idle: Queue = Queue()
+        self.created = 0
+        self.reserved = 0
+        self.lock = Lock()
+
+    def get(self):
+        """Take a connection, blocking when `maxsize` are already in use."""
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            create = self.created < self.maxsize
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    def reserve(self, count: int):
+        """Make room for `count` more connections that are held until release().
+
+        Writers hold their connection for as long as their handler is
+        open, so without room for all of them the last would wait forever.
+        """
+        with self.lock:
+            self.reserved += count
+            self.maxsize = max(self.maxsize, self.reserved)
+
+    def release(self, count: int):
+        with self.lock:
+            self.reserved -= count
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
+
+class PostgresWriter(Thread):
+    """Writes rows for a PostgresHandler over a single pooled connection.
+
+    Either called directly by the handler or run as a background thread
+    draining the handler's queue.
+    """
+
+    def __init__(self, handler: 'PostgresHandler'):
+        self.handler = handler
+        self.conn = handler.pool.get()
+        self.conn.set_session(autocommit=handler.autocommit)
+        self.cursor = self.conn.cursor()
+        self.autocommit = handler.autocommit
+        self.commitfreq = handler.commitfreq
+        self.uncommitted = 0
+        self.buffer = []
+        super().__init__()
+
+    def run(self):
+        drain_queue(self.handler.queue, self.write, self.flush, "Postgres writer")
+        self.close()
+
+    def write(self, records):
+        if self.handler.copy:
+            self.buffer.extend(records)
+            if len(self.buffer) >= self.handler.flush_size:
+                self.write_buffer()
+            return
+        if self.autocommit or self.commitfreq is None:
+            self.write_batch(records)
+            return
+        # Split the batch so commits still happen every `commitfreq` rows.
+        while records:
+            room = max(self.commitfreq - self.uncommitted, 1)
+            self.write_batch(records[:room])
+            records = records[room:]
+
+    def write_buffer(self):
+        """Write out any rows buffered for COPY."""
+        if not self.buffer:
+            return
+        records = self.buffer
+        self.buffer = []
+        self.write_batch(records)
+
+    def flush(self) -> bool:
+        """Write out buffered rows and commit them. Returns whether the commit succeeded."""
+        self.write_buffer()
+        if self.autocommit:
+            return True
+        committed = self.do_commit()
+        self.uncommitted = 0
+        return committed
+
+    def copy_rows(self, records):
+        data = "".join(["\t".join([copy_escape(v) for v in params]) + "\n" for params in records])
+        self.cursor.copy_expert(self.handler.copy_query, StringIO(data))
+
+    def send_rows(self, records):
+        if self.handler.copy:
+            self.copy_rows(records)
+        else:
+            # A single page keeps the batch atomic, even with autocommit.
+            execute_batch(self.cursor, self.handler.query, records, page_size=len(records))
+
+    def write_batch(self, records):
+        rejected = write_isolated(records, self.send_rows, self.savepoint, self.release_savepoint,
+                                  self.rollback_savepoint, (psycopg2.Error, UnicodeError), self.handler)
+        self.uncommitted += len(records) - rejected
+        self.check_commit()
+
+    def savepoint(self):
+        # Every statement is its own transaction with autocommit, so
+        # there is nothing to protect.
+        if not self.autocommit:
+            self.cursor.execute("SAVEPOINT credparser_batch")
+
+    def release_savepoint(self):
+        if not self.autocommit:
+            self.cursor.execute("RELEASE SAVEPOINT credparser_batch")
+
+    def rollback_savepoint(self):
+        if not self.autocommit:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT credparser_batch")
+
+    def do_commit(self) -> bool:
+        logging.debug(f"Committing Transaction")
+        stats = self.handler.stats
+        try:
+            start = stats.start()
+            self.conn.commit()
+            stats.stop("db_commit", start)
+            return True
+        except psycopg2.Error as e:
+            logging.debug(f"Caught Error on Commit: {e}")
+            return False
+
+    def check_commit(self):
+        if self.autocommit:
+            return
+        if self.commitfreq is not None and self.uncommitted >= self.commitfreq:
+            self.do_commit()
+            self.uncommitted = 0
+
+    def rollback(self):
+        logging.debug("Rolling Back Changes")
+        self.conn.rollback()
+
+    def close(self):
+        """Flush and hand the connection back to the pool."""
+        self.flush()
+        self.cursor.close()
+        self.handler.pool.put(self.conn)
+
+
+class PostgresHandler(OutputHandler):
+    """Writes rows to a Postgres table.
+
+    Rows are written by `writers` background threads, each with its own
+    connection from a pool shared by every handler for the same database.
+    Parsers block once `queue_size` batches are waiting to be written (0
+    means no limit). With `commitfreq=None` rows are only committed by
+    flush(), so every commit lines up with a checkpoint. With `writers=0` rows are written inline by the
+    calling thread instead.
+    """
+
+    pools: Dict[tuple, ConnectionPool] = {}
+    pools_lock = Lock()
+
+    @classmethod
+    def get_pool(cls, key: tuple, connect: Callable[[], Any], maxsize: int) -> ConnectionPool:
+        """Get the pool shared by every handler using the same server, database and user."""
+        with cls.pools_lock:
+            if key not in cls.pools:
+                cls.pools[key] = ConnectionPool(connect, maxsize)
+            return cls.pools[key]
+
+    @classmethod
+    def close_pools(cls):
+        with cls.pools_lock:
+            for pool in cls.pools.values():
+                pool.close()
+            cls.pools.clear()
+
+    def __init__(self,
+                 username: str,
+                 password: str,
+                 database: str,
+                 table: str,
+                 host: str = "localhost",
+                 port: int = 5432,
+                 querytemplate: str = "INSERT INTO {table} ({fields}) VALUES ({types})",
+                 fieldnames: List[str] = ["username", "password"],
+                 fieldtypes: Optional[List[str]] = None,
+                 autocommit: bool = False,
+                 commitfreq: int = None,
+                 copy: bool = False,
+                 flush_size: int = 10000,
+                 rejects_handler: Optional[OutputHandler] = None,
+                 pool_size: int = 4,
+                 writers: int = 1,
+                 queue_size: int = 16,
+                 connection_factory: Optional[Callable[[], Any]] = None):
+        if connection_factory is None:
+            connection_factory = lambda: psycopg2.connect(user=username,
+                                                          password=password,
+                                                          dbname=database,
+                                                          host=host,
+                                                          port=port)
+        self.pool = PostgresHandler.get_pool((host, port, database, username), connection_factory, pool_size)
+        self.autocommit = autocommit
+        self.table = table
+        self.querytemplate = querytemplate
+        self.fieldnames = fieldnames
+        self.fieldtypes = fieldtypes if fieldtypes is not None else ["%s"] * len(self.fieldnames)
+        self.commitfreq = commitfreq
+        self.copy = copy
+        self.flush_size = flush_size
+        self.rejects_handler = rejects_handler if rejects_handler is not None else LoggingHandler("Rejected")
+        self.rejects_handler.attach()
+        self.prep_query()
+        self.queue: Optional[Queue] = Queue(queue_size) if writers > 0 else None
+        self.pool.reserve(max(writers, 1))
+        self.writers = [PostgresWriter(self) for _ in range(max(writers, 1))]
+        if self.queue is not None:
+            for writer in self.writers:
+                writer.start()
+        super().__init__()
+
+    def prep_query(self):
+        fields = ",".join(self.fieldnames)
+        types = ",".join(self.fieldtypes)
+        self.query = self.querytemplate.format(table=self.table, 
+                                          fields=fields, 
+                                          types=types)
+        self.copy_query = f"COPY {self.table} ({fields}) FROM STDIN"
+
+    def do_output(self, params):
+        self.write([params])
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        self.write(records)
+
+    def write(self, records):
+        if self.queue is None:
+            self.writers[0].write(records)
+        else:
+            self.queue.put(records)
+
+    def flush(self) -> bool:
+        """Write and commit everything handed over so far.
+
+        Blocks until every writer has caught up. Returns whether all the
+        commits succeeded.
+        """
+        if self.queue is None:
+            with self.lock:
+                return self.writers[0].flush()
+        # One request at a time, or writers could each take a different one and wait forever.
+        with self.lock:
+            request = FlushRequest(len(self.writers))
+            for _ in self.writers:
+                self.queue.put(request)
+            return request.wait()
+
+    def done(self):
+        logging.info(f"Exiting Postgres Handler")
+        if self.queue is None:
+            self.writers[0].close()
+        else:
+            for _ in self.writers:
+                self.queue.put(STOP_DRAINING)
+            for writer in self.writers:
+                writer.join()
+        self.pool.release(len(self.writers))
+        self.rejects_handler.detach()
@@ -0,0 +1,402 @@
+import bz2
+import gzip
+import lzma
+import os
+import stat
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Thread
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".zst": "zstd",
+}
+
+BZ2_BLOCK_MAGIC = [b"1AY&SY", b"\x17rE8P\x90"]
+"""What follows a bzip2 header: the first block, or the end of the stream for empty files."""
+
+BGZF_HEADER = b"\x1f\x8b\x08\x04"
+
+STDIN = "-"
+"""The filename used for standard input."""
+
+
+class BlockReader:
+    """Reads a binary stream in large blocks and yields them as batches of lines.
+
+    Partial lines at the end of a block are carried over into the next one,
+    so every yielded line is complete. The line boundaries are the same as
+    iterating over the file, but without the trailing newline.
+    """
+
+    def __init__(self, fileobj: BinaryIO, blocksize: int = DEFAULT_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.offset = 0
+        """Number of bytes handed out as complete lines so far."""
+
+    def __iter__(self) -> Iterator[List[bytes]]:
+        read = self.fileobj.read
+        blocksize = self.blocksize
+        # The start of a line that hasn't ended yet. Blocks without a
+        # newline are only joined once one turns up, so a long line
+        # isn't copied again for every block of it.
+        pieces = []
+        while True:
+            block = read(blocksize)
+            if not block:
+                break
+            if b"\n" not in block:
+                pieces.append(block)
+                continue
+            if pieces:
+                pieces.append(block)
+                block = b"".join(pieces)
+            lines = block.split(b"\n")
+            carry = lines.pop()
+            pieces = [carry] if carry else []
+            self.offset += len(block) - len(carry)
+            yield lines
+        if pieces:
+            carry = b"".join(pieces)
+            self.offset += len(carry)
+            yield [carry]
+
+
+def iter_ranges(fileobj: BinaryIO, size: int, rangesize: int = DEFAULT_BLOCK_SIZE, start: int = 0) -> Iterator[Tuple[int, int]]:
+    """Split a seekable file into byte ranges of roughly `rangesize` bytes.
+
+    Every range ends just after a newline (or at the end of the file) so
+    each one can be parsed on its own. `start` must be the start of a line.
+    """
+    while start < size:
+        end = start + rangesize
+        if end >= size:
+            yield start, size
+            return
+        fileobj.seek(end)
+        while True:
+            chunk = fileobj.read(1 << 16)
+            if not chunk:
+                end = size
+                break
+            ind = chunk.find(b"\n")
+            if ind != -1:
+                end += ind + 1
+                break
+            end += len(chunk)
+        yield start, end
+        start = end
+
+
+def read_range(filename: str, start: int, end: int) -> List[bytes]:
+    """Read the lines in a newline aligned byte range of a file."""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b"\n")
+    last = lines.pop()
+    if last:
+        lines.append(last)
+    return lines
+
+
+def is_stream(filename: str) -> bool:
+    """Whether the input is standard input or something else that isn't a regular file, like a FIFO."""
+    return filename == STDIN or not stat.S_ISREG(os.stat(filename).st_mode)
+
+
+def input_size(filename: str) -> Optional[int]:
+    """The size of an input file, or None for streams, whose size isn't known."""
+    if is_stream(filename):
+        return None
+    return os.path.getsize(filename)
+
+
+def is_bz2(head: bytes) -> bool:
+    """Whether the first 10 bytes of a file are a bzip2 header and block.
+
+    "BZh" alone could just as well be the start of a line of text.
+    """
+    return head[:3] == b"BZh" and head[3:4] in b"123456789" and len(head) >= 10 and head[4:10] in BZ2_BLOCK_MAGIC
+
+
+def compression_from_head(head: bytes, filename: str) -> Optional[str]:
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    if is_bz2(head):
+        return "bz2"
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def detect_compression(filename: str) -> Optional[str]:
+    """Work out how a file is compressed from its magic bytes, or failing that its extension."""
+    with open(filename, "rb") as f:
+        head = f.read(10)
+    return compression_from_head(head, filename)
+
+
+def open_decompressed(raw: BinaryIO, compression: str) -> BinaryIO:
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(raw)
+    if compression == "xz":
+        return lzma.LZMAFile(raw)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading zstd files requires the zstandard package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    raise ValueError(f"Unknown compression {compression!r}")
+
+
+def is_bgzf(head: bytes) -> bool:
+    """Whether the first 18 bytes of a gzip file are a BGZF block header, which stores the block's size."""
+    return len(head) == 18 and head[:4] == BGZF_HEADER and head[12:14] == b"BC"
+
+
+def iter_bgzf_groups(raw: BinaryIO, group_size: int) -> Iterator[bytes]:
+    """Read whole BGZF blocks, without decompressing them, in groups of about `group_size` bytes."""
+    group = []
+    size = 0
+    while True:
+        header = raw.read(18)
+        if not header:
+            break
+        if len(header) < 18 or header[:4] != BGZF_HEADER or header[12:14] != b"BC":
+            raise ValueError("Invalid BGZF block header")
+        blocksize = int.from_bytes(header[16:18], "little") + 1
+        group.append(header + raw.read(blocksize - 18))
+        size += blocksize
+        if size >= group_size:
+            yield b"".join(group)
+            group = []
+            size = 0
+    if group:
+        yield b"".join(group)
+
+
+class CountingReader:
+    """Counts the bytes read from a stream, since pipes can't tell() their position.
+
+    Sized reads return whatever has arrived rather than waiting for the
+    whole size, so lines written slowly to a pipe are parsed as they come.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size) if size < 0 else self.fileobj.read1(size)
+        self.count += len(data)
+        return data
+
+    read1 = read
+
+    def tell(self) -> int:
+        return self.count
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ThreadedReader:
+    """A read() interface over blocks produced on a background thread.
+
+    Used so decompression overlaps parsing. `blocks` yields pairs of
+    data and how far into the underlying file reading had got. The data
+    may be a Future when blocks are decompressed in parallel.
+    """
+
+    def __init__(self, blocks: Iterator[Tuple[Union[bytes, Future], int]], prefetch: int = 4):
+        self.queue: Queue = Queue(prefetch)
+        self.position = 0
+        self.eof = False
+        self.closed = False
+        self.leftover = b""
+        self.thread = Thread(target=self.produce, args=(blocks,), daemon=True)
+        self.thread.start()
+
+    def produce(self, blocks):
+        try:
+            for item in blocks:
+                if self.closed:
+                    return
+                self.queue.put(item)
+        except Exception as e:
+            self.queue.put((e, None))
+            return
+        self.queue.put((b"", None))
+
+    def read(self, size: int = -1) -> bytes:
+        """Return the next block. `size` is ignored; blocks are whatever size was produced."""
+        if self.leftover:
+            data, self.leftover = self.leftover, b""
+            return data
+        while not self.eof:
+            data, position = self.queue.get()
+            if isinstance(data, BaseException):
+                self.eof = True
+                raise data
+            if position is None:
+                self.eof = True
+                break
+            if isinstance(data, Future):
+                data = data.result()
+            self.position = position
+            if data:
+                return data
+        return b""
+
+    def peek(self, size: int) -> bytes:
+        """Return at least `size` bytes (unless the data ends first) without consuming them."""
+        data = b""
+        while len(data) < size:
+            block = self.read()
+            if not block:
+                break
+            data += block
+        self.leftover = data
+        return data
+
+    def skip(self, count: int):
+        """Read and throw away `count` bytes."""
+        while count > 0:
+            data = self.read()
+            if not data:
+                break
+            if len(data) > count:
+                self.leftover = data[count:]
+                break
+            count -= len(data)
+
+    def close(self):
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+class InputFile:
+    """An input file, decompressed on background threads when it is compressed.
+
+    `position` is how far reading has got into the file on disk, so
+    progress can be measured against its size even when it is compressed.
+    BGZF files (gzip files made of many independently compressed members
+    with their sizes in the headers) are decompressed by several threads
+    at once, unless they are streams.
+
+    Streams (standard input as "-", or FIFOs) are read on a background
+    thread even when they aren't compressed, and `position` counts the
+    bytes read from them.
+    """
+
+    def __init__(self, filename: str, blocksize: int = DEFAULT_BLOCK_SIZE, threads: int = 2):
+        self.filename = filename
+        self.blocksize = blocksize
+        self.streaming = is_stream(filename)
+        if filename == STDIN:
+            # A separate file object for the same descriptor, since worker
+            # processes forked while it is being read close sys.stdin, which
+            # would block on the lock the reading thread holds.
+            self.raw = open(os.dup(sys.stdin.fileno()), "rb")
+        else:
+            self.raw = open(filename, "rb")
+        head = self.raw.peek(18)[:18]
+        self.compression = compression_from_head(head, filename)
+        if self.streaming:
+            self.raw = CountingReader(self.raw)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.compression is None:
+            self.stream = ThreadedReader(self.iter_raw()) if self.streaming else self.raw
+        elif self.compression == "gzip" and threads > 1 and not self.streaming and is_bgzf(head):
+            # Not for streams, where waiting for whole groups of blocks
+            # would hold up lines that have already arrived.
+            self.executor = ThreadPoolExecutor(threads)
+            self.stream = ThreadedReader(self.iter_parallel(), prefetch=threads * 2)
+        else:
+            self.decompressed = open_decompressed(self.raw, self.compression)
+            self.stream = ThreadedReader(self.iter_decompressed())
+
+    @property
+    def position(self) -> int:
+        if self.stream is self.raw:
+            return self.raw.tell()
+        return self.stream.position
+
+    def peek(self, size: int) -> bytes:
+        """Look at the start of a stream without consuming it."""
+        if self.stream is self.raw:
+            position = self.raw.tell()
+            data = self.raw.read(size)
+            self.raw.seek(position)
+            return data
+        return self.stream.peek(size)
+
+    def skip(self, offset: int):
+        """Move `offset` bytes into the (decompressed) data.
+
+        Plain files are seeked, compressed ones have to be decompressed up
+        to that point.
+        """
+        if offset == 0:
+            return
+        if self.stream is self.raw:
+            self.raw.seek(offset)
+        else:
+            self.stream.skip(offset)
+
+    def iter_raw(self):
+        position = 0
+        while True:
+            data = self.raw.read(self.blocksize)
+            if not data:
+                break
+            position += len(data)
+            yield data, position
+
+    def iter_decompressed(self):
+        # Streams are read a block at a time as the data arrives.
+        read = self.decompressed.read1 if self.streaming else self.decompressed.read
+        while True:
+            data = read(self.blocksize)
+            if not data:
+                break
+            yield data, self.raw.tell()
+
+    def iter_parallel(self):
+        # Only the compressed size of each group is known up front, so
+        # groups are a quarter of the block size to keep blocks near it.
+        for group in iter_bgzf_groups(self.raw, max(self.blocksize // 4, 1)):
+            yield self.executor.submit(gzip.decompress, group), self.raw.tell()
+
+    def close(self):
+        if self.stream is not self.raw:
+            self.stream.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,182 @@
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from threading import Thread
+from typing import Callable, List, Optional
+from CredentialParser.CredentialParser import CredentialParser
+from CredentialParser.Reader import input_size
+from CredentialParser.Stats import Stats
+from CredentialParser.util import naturalsize, timestr
+
+
+class Scheduler(Thread):
+    """Runs a CredentialParser for each input file, with a bounded number running at once.
+
+    Files are started largest first so a big file isn't left running on
+    its own at the end of the job. When `processes` is set, every parser
+    shares one pool of worker processes instead of parsing on its own
+    thread.
+    """
+
+    def __init__(self,
+                 files: List[str],
+                 parser_factory: Callable[[str, Optional[Executor]], CredentialParser],
+                 max_running: int = 4,
+                 processes: int = 0,
+                 poll_interval: float = 0.05):
+        self.unstarted: List[str] = []
+        """Files that couldn't be read, or whose parser couldn't be created."""
+        sizes = {}
+        for f in files:
+            try:
+                sizes[f] = input_size(f)
+            except OSError as e:
+                logging.error(f"{f}: can't be read: {e}")
+                self.unstarted.append(f)
+        # Streams have no size, and go first since whatever is writing to them is waiting.
+        self.files = sorted(sizes, key=lambda f: (sizes[f] is not None, -(sizes[f] or 0), f))
+        self.parser_factory = parser_factory
+        self.max_running = max_running
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.streaming = any(size is None for size in sizes.values())
+        """Whether any input is a stream, in which case there is no percentage or ETA."""
+        self.total_size = sum(size or 0 for size in sizes.values())
+        self.parsers: List[CredentialParser] = []
+        self.starttime = None
+        self.endtime = None
+        super().__init__()
+
+    def __str__(self):
+        if self.streaming:
+            return (f"{len(self.finished)}/{len(self.files)} files | {self.processed_count} lines | "
+                    f"{naturalsize(self.byte_speed)}/s | {self.natural_runtime} elapsed")
+        return (f"{len(self.finished)}/{len(self.files)} files | {self.percent_complete:.02f}% | "
+                f"{naturalsize(self.byte_speed)}/s | {self.natural_eta} left | {self.natural_runtime} elapsed")
+
+    @property
+    def running(self) -> List[CredentialParser]:
+        return [p for p in self.parsers if p.is_alive()]
+
+    @property
+    def finished(self) -> List[CredentialParser]:
+        return [p for p in self.parsers if p.state == "finished"]
+
+    @property
+    def failed(self) -> List[str]:
+        """The files that failed to parse, or to start parsing."""
+        return self.unstarted + [p.filename for p in self.parsers if p.state == "failed"]
+
+    @property
+    def processed_bytes(self):
+        return sum(p.processed_bytes for p in self.parsers)
+
+    @property
+    def resumed_bytes(self):
+        return sum(p.resumed_bytes for p in self.parsers)
+
+    @property
+    def processed_count(self):
+        return sum(p.processed_count for p in self.parsers)
+
+    @property
+    def input_count(self) -> Optional[int]:
+        """The lines in every file started so far, once they have all been counted (with count_lines)."""
+        if not self.parsers or any(p.input_count is None for p in self.parsers):
+            return None
+        return sum(p.input_count for p in self.parsers)
+
+    @property
+    def runtime(self) -> timedelta:
+        if self.starttime is None:
+            return timedelta(seconds=0)
+        endtime = self.endtime or datetime.now()
+        return endtime - self.starttime
+
+    @property
+    def natural_runtime(self):
+        return timestr(self.runtime)
+
+    @property
+    def percent_complete(self) -> Optional[float]:
+        if self.streaming:
+            return None
+        if self.total_size == 0:
+            return 100.0
+        return self.processed_bytes / self.total_size * 100
+
+    @property
+    def byte_speed(self):
+        seconds = self.runtime.total_seconds()
+        if seconds == 0:
+            return 0
+        return (self.processed_bytes - self.resumed_bytes) / seconds
+
+    @property
+    def eta(self):
+        if self.byte_speed == 0 or self.streaming:
+            return timedelta(seconds=0)
+        left = self.total_size - self.processed_bytes
+        return timedelta(seconds=left/self.byte_speed)
+
+    @property
+    def natural_eta(self):
+        return timestr(self.eta)
+
+    def stats(self) -> dict:
+        """Counters and stage timings for the whole job, as plain data.
+
+        Parser stats are added up across files, handler stats across
+        handlers of the same type. Files still running are also listed on
+        their own.
+        """
+        parsers = list(self.parsers)
+        handlers = {}
+        for parser in parsers:
+            for handler in (parser.output_handler, parser.error_handler):
+                # Include handlers wrapped by another handler, like DedupHandler.
+                while handler is not None and id(handler) not in handlers:
+                    handlers[id(handler)] = handler
+                    handler = getattr(handler, "handler", None)
+        by_type = {}
+        for handler in handlers.values():
+            by_type.setdefault(type(handler).__name__, []).append(handler.stats)
+        totals = Stats.combine([p.stats for p in parsers])
+        totals["counters"].update(lines=self.processed_count, bytes=self.processed_bytes)
+        return dict(elapsed=self.runtime.total_seconds(),
+                    files_finished=len(self.finished),
+                    files_total=len(self.files),
+                    input_lines=self.input_count,
+                    percent_complete=self.percent_complete,
+                    byte_speed=self.byte_speed,
+                    parsers=totals,
+                    handlers={name: Stats.combine(stats) for name, stats in by_type.items()},
+                    running=[p.stats_snapshot() for p in parsers if p.is_alive()])
+
+    def wait_for_slot(self):
+        while len(self.running) >= self.max_running and not CredentialParser.stop:
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        self.starttime = datetime.now()
+        executor = ProcessPoolExecutor(self.processes) if self.processes > 0 else None
+        try:
+            for filename in self.files:
+                self.wait_for_slot()
+                if CredentialParser.stop:
+                    break
+                try:
+                    parser = self.parser_factory(filename, executor)
+                except Exception as e:
+                    logging.exception(f"{filename}: couldn't start parsing: {e}")
+                    self.unstarted.append(filename)
+                    continue
+                self.parsers.append(parser)
+                parser.start()
+            for parser in self.parsers:
+                parser.join()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self.endtime = datetime.now()
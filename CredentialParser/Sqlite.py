@@ -0,0 +1,134 @@
+import logging
+import sqlite3
+from queue import Queue
+from threading import Thread
+from typing import List, Optional
+from CredentialParser.OutputHandler import FlushRequest, LoggingHandler, OutputHandler, STOP_DRAINING, drain_queue, write_isolated
+
+SYNCHRONOUS_LEVELS = ["OFF", "NORMAL", "FULL"]
+
+
+class SqliteHandler(OutputHandler):
+    """Writes rows to a table in a SQLite database file.
+
+    SQLite only allows one writer at a time, so every row goes through a
+    queue to a single writer thread that owns the connection. Rows are
+    inserted with executemany inside large transactions, committed every
+    `commit_rows` rows (or only on flush() if it is None, so commits line
+    up with checkpoints). The database uses WAL journaling, `synchronous`
+    ("OFF", "NORMAL" or "FULL") and a page cache of `cache_size` MB.
+    Indexes on the `indexes` fields are only created once the load is
+    done, which is much faster than keeping them up to date row by row.
+    Parsers block once `queue_size` batches are waiting to be written.
+    """
+
+    def __init__(self,
+                 path: str,
+                 table: str = "credentials",
+                 querytemplate: str = "INSERT INTO {table} ({fields}) VALUES ({types})",
+                 fieldnames: List[str] = ["username", "password"],
+                 indexes: Optional[List[str]] = None,
+                 commit_rows: Optional[int] = 100000,
+                 synchronous: str = "NORMAL",
+                 cache_size: int = 64,
+                 rejects_handler: Optional[OutputHandler] = None,
+                 queue_size: int = 16):
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"synchronous must be one of {SYNCHRONOUS_LEVELS}, not {synchronous!r}")
+        self.path = path
+        self.table = table
+        self.fieldnames = fieldnames
+        self.indexes = indexes or []
+        self.commit_rows = commit_rows
+        self.query = querytemplate.format(table=table,
+                                          fields=",".join(fieldnames),
+                                          types=",".join(["?"] * len(fieldnames)))
+        self.rejects_handler = rejects_handler if rejects_handler is not None else LoggingHandler("Rejected")
+        self.rejects_handler.attach()
+        # Opened here so a bad path fails straight away, but only ever
+        # used by the writer thread from now on.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.conn.execute(f"PRAGMA cache_size=-{cache_size << 10}")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({','.join(f'{f} TEXT' for f in fieldnames)})")
+        self.uncommitted = 0
+        self.queue = Queue(queue_size)
+        super().__init__()
+        self.writer = Thread(target=self.drain, daemon=True)
+        self.writer.start()
+
+    def drain(self):
+        drain_queue(self.queue, self.write, self.commit, "SQLite writer")
+        self.close()
+
+    def write(self, records):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        rejected = write_isolated(records, self.send_rows, self.savepoint, self.release_savepoint,
+                                  self.rollback_savepoint, (sqlite3.Error,), self)
+        self.uncommitted += len(records) - rejected
+        if self.commit_rows is not None and self.uncommitted >= self.commit_rows:
+            self.commit()
+
+    def send_rows(self, records):
+        self.conn.executemany(self.query, records)
+
+    def savepoint(self):
+        self.conn.execute("SAVEPOINT credparser_batch")
+
+    def release_savepoint(self):
+        self.conn.execute("RELEASE credparser_batch")
+
+    def rollback_savepoint(self):
+        # Unlike Postgres, rolling back to a savepoint leaves it open.
+        self.conn.execute("ROLLBACK TO credparser_batch")
+        self.conn.execute("RELEASE credparser_batch")
+
+    def commit(self) -> bool:
+        self.uncommitted = 0
+        if not self.conn.in_transaction:
+            return True
+        logging.debug(f"Committing Transaction")
+        start = self.stats.start()
+        try:
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logging.debug(f"Caught Error on Commit: {e}")
+            return False
+        self.stats.stop("db_commit", start)
+        return True
+
+    def create_indexes(self):
+        for field in self.indexes:
+            logging.info(f"Indexing {self.table}.{field}")
+            start = self.stats.start(sampled=False)
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_{field}_idx ON {self.table} ({field})")
+            self.stats.stop("db_index", start)
+
+    def close(self):
+        self.commit()
+        self.create_indexes()
+        self.conn.execute("PRAGMA optimize")
+        self.conn.close()
+
+    def do_output(self, params):
+        self.queue.put([params])
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+        self.queue.put(records)
+
+    def flush(self) -> bool:
+        """Commit everything handed over so far. Returns whether the commit succeeded."""
+        with self.lock:
+            request = FlushRequest(1)
+            self.queue.put(request)
+            return request.wait()
+
+    def done(self):
+        logging.info(f"Exiting SQLite Handler")
+        self.queue.put(STOP_DRAINING)
+        self.writer.join()
+        self.rejects_handler.detach()
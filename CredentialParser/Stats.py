@@ -0,0 +1,168 @@
+import json
+import random
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+class Histogram:
+    """Durations bucketed by powers of two microseconds, so recording one is cheap."""
+
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        index = min(int(seconds * 1e6).bit_length(), Histogram.BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'Histogram'):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> float:
+        """The upper bound of the bucket the `p`th percentile falls in, in seconds."""
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return dict(count=self.count,
+                    total=self.total,
+                    mean=self.total / self.count if self.count else 0.0,
+                    p50=self.percentile(50),
+                    p90=self.percentile(90),
+                    p99=self.percentile(99),
+                    max=self.max)
+
+
+class Stats:
+    """Counters and timing histograms for the stages of one parser or handler.
+
+    Everything is a no-op until enable() is called. Counters are always
+    exact once enabled, but only one in every `sample_rate` timing is
+    taken, to keep the cost of timing down. Timings are recorded per
+    batch of lines, not per line.
+    """
+
+    enabled = False
+    sample_rate = 1
+
+    @classmethod
+    def enable(cls, sample_rate: int = 1):
+        cls.enabled = True
+        cls.sample_rate = max(sample_rate, 1)
+
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, Histogram] = {}
+        self.lock = Lock()
+
+    def incr(self, name: str, count: int = 1):
+        if not Stats.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def start(self, sampled: bool = True) -> Optional[float]:
+        """Start timing something if this call is sampled. Pass the result to stop().
+
+        Rare events like flushes can pass `sampled=False` to always be timed.
+        """
+        if not Stats.enabled:
+            return None
+        # Sampled at random, since every nth call would always land on the
+        # same stage when stages are timed in a fixed order.
+        if sampled and Stats.sample_rate > 1 and random.random() * Stats.sample_rate >= 1:
+            return None
+        return time.perf_counter()
+
+    def stop(self, name: str, start: Optional[float]):
+        if start is not None:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Histogram()
+            timer.add(seconds)
+
+    def timed(self, iterable: Iterable, name: str) -> Iterable:
+        """Time how long each item of `iterable` takes to produce."""
+        if not Stats.enabled:
+            return iterable
+        return self.iter_timed(iter(iterable), name)
+
+    def iter_timed(self, iterator: Iterator, name: str):
+        while True:
+            start = self.start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.stop(name, start)
+            yield item
+
+    def merge(self, other: 'Stats'):
+        with other.lock:
+            counters = dict(other.counters)
+            timers = list(other.timers.items())
+        with self.lock:
+            for name, count in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + count
+            for name, timer in timers:
+                self.timers.setdefault(name, Histogram()).merge(timer)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(counters=dict(self.counters),
+                        timers={name: timer.to_dict() for name, timer in self.timers.items()})
+
+    @staticmethod
+    def combine(stats: List['Stats']) -> dict:
+        """Add up several Stats into one snapshot."""
+        total = Stats()
+        for s in stats:
+            total.merge(s)
+        return total.snapshot()
+
+
+class StatsWriter(Thread):
+    """Appends the output of `source` to a JSON lines file every `interval` seconds, and once more when stopped."""
+
+    def __init__(self, path: str, source: Callable[[], dict], interval: float = 5):
+        self.path = path
+        self.source = source
+        self.interval = interval
+        self.stopped = Event()
+        super().__init__(daemon=True)
+
+    def write(self):
+        line = json.dumps(dict(time=time.time(), **self.source()))
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
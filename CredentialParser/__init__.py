@@ -1,3 +1,14 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+"""When the package started being imported, so startup time can be measured."""
+
 from CredentialParser.CredentialParser import *
 from CredentialParser.OutputHandler import *
 
+
+def __getattr__(name):
+    # Postgres output is only imported when it's used, like in OutputHandler.
+    if name in POSTGRES_NAMES:
+        from CredentialParser import Postgres
+        return getattr(Postgres, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
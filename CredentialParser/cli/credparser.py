@@ -1,10 +1,21 @@
-from CredentialParser.OutputHandler import LoggingHandler, FileHandler
+from CredentialParser.OutputHandler import FileHandler, RejectsHandler
 from enum import auto
-from CredentialParser.CredentialParser import ParsingMode
+from CredentialParser.CredentialParser import CredentialParser, ParsingMode
 import time
 from argparse import ArgumentParser
-from CredentialParser import CredentialParser, PostgresHandler
+from CredentialParser import IMPORT_STARTED
+from CredentialParser.Checkpoint import Checkpoint
+from CredentialParser.Dedup import DedupHandler, Deduplicator
+from CredentialParser.Index import DEFAULT_INDEX_BLOCK_SIZE, IndexHandler, IndexReader
+from CredentialParser.Partition import PARTITION_KEYS, PartitionedHandler
+from CredentialParser.Reader import COMPRESSION_EXTENSIONS, STDIN
+from CredentialParser.Scheduler import Scheduler
+from CredentialParser.Stats import Stats, StatsWriter
+from CredentialParser.cli.registry import OutputModes, get_factory
+from CredentialParser.util import expand_paths
+import os
 import signal
+import sys
 import logging
 from pathlib import Path
 caught_signal = False
@@ -14,15 +25,55 @@ def parse_arguments():
     parser = ArgumentParser("CredentialParser")
     parser.add_argument("-s", "--delimeters", nargs="+", metavar="DELIM", default=[":",";"], help="Delimeters used to split credentials.")
     parser.add_argument("-m", "--mode", default="FIRST_FOUND", choices=["FIRST_FOUND", "LOWEST_INDEX"], help="The strategy used to determine the proper delimeter to use for each value.")
-    parser.add_argument("files", nargs="+", metavar="FILE", help="The files to parse.")
-    parser.add_argument("-o", "--output-mode", choices=["file", "postgres"], default="file", help="The output mode to use.")
-    parser.add_argument("--refresh-time", default=1, help="The refresh frequency for the progress text.")
+    parser.add_argument("files", nargs="+", metavar="FILE", help="The files to parse. Directories are searched recursively and glob patterns are expanded. '-' reads from standard input, and FIFOs are read as streams.")
+    parser.add_argument("-o", "--output-mode", choices=OutputModes(), default="file", metavar="MODE", help="The output mode to use: %(choices)s. stdout writes every file's records to standard output, and everything else that would be printed goes to stderr. Other packages can add modes with a 'credparser.output_handlers' entry point.")
+    parser.add_argument("--refresh-time", type=float, default=1, help="The refresh frequency for the progress text.")
+    parser.add_argument("--count-lines", action="store_true", default=False, help="Count the exact number of lines in each file while parsing, and show lines parsed out of that total in the progress text and --stats. Progress is based on bytes read so this is not required.")
+    parser.add_argument("--block-size", type=int, default=1 << 20, help="The number of bytes to read from each file at a time.")
+    parser.add_argument("--no-profile", action="store_true", default=False, help="Don't sample the start of each file to find its main delimeter. With -m LOWEST_INDEX files are only sampled to log what was found with -vv.")
+    parser.add_argument("--profile-size", type=int, default=1 << 16, help="The number of bytes sampled from the start of each file to find its main delimeter.")
+    parser.add_argument("--fast-delimeter", metavar="DELIM", help="Use this delimeter as the fast path instead of the one found by profiling. It must be one of --delimeters. (Only used with -m FIRST_FOUND)")
+    parser.add_argument("--decompress-threads", type=int, default=2, help="The number of threads used to decompress BGZF (block gzip) files. Other compressed files are decompressed on one background thread.")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="The number of worker processes shared by all files. Files are split into newline aligned chunks of --block-size bytes and parsed in parallel. By default each file is parsed on its own thread.")
+    parser.add_argument("-P", "--parallel-files", type=int, default=os.cpu_count() or 1, help="The maximum number of files to parse at once. Files are started largest first. Default: number of CPUs")
+    parser.add_argument("--unordered", action="store_true", default=False, help="When using multiple jobs, write results as soon as each chunk is parsed instead of preserving the input order.")
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Display verbose output. More = more vewbose." )
+    parser.add_argument("--rejects", metavar="FILE", help="Append lines that couldn't be parsed to FILE, with surrounding whitespace stripped. Either way they are counted and a sample of them is logged at debug level.")
+    stats_args = parser.add_argument_group("Stats")
+    stats_args.add_argument("--stats", metavar="FILE", help="Collect counters and per stage timings and append them to FILE as JSON lines.")
+    stats_args.add_argument("--stats-interval", type=float, default=5, help="The number of seconds between lines written to the --stats file.")
+    stats_args.add_argument("--stats-sample", type=int, default=1, metavar="N", help="Only time one in every N batches, to make collecting stats cheaper.")
+    checkpoint_args = parser.add_argument_group("Checkpoints")
+    checkpoint_args.add_argument("--checkpoint", metavar="FILE", help="Periodically record how far each file has got in FILE so an interrupted run can be resumed. Database output is then only committed at checkpoints, and files are parsed one at a time.")
+    checkpoint_args.add_argument("--checkpoint-interval", type=float, default=60, help="The number of seconds between checkpoints.")
+    checkpoint_args.add_argument("--resume", action="store_true", default=False, help="Resume from the --checkpoint file. Files that finished are skipped and output files are appended to.")
+    dedup_args = parser.add_argument_group("Deduplication")
+    dedup_args.add_argument("--dedup", action="store_true", default=False, help="Drop records that were already output, across all files.")
+    dedup_args.add_argument("--dedup-memory", type=int, default=512, metavar="MB", help="The memory budget in MB for remembering seen records. Beyond it they are spilled to disk.")
+    dedup_args.add_argument("--dedup-dir", help="The directory to spill seen records to. Defaults to the system temp directory.")
     file_args = parser.add_argument_group("File Output")
     file_args.add_argument("-r", "--replacement-delimiter", default="\t", help="The new delimiter to use when writing to the new file.")
     file_args.add_argument("-O", "--output-suffix", default="_sanitized", help="The output suffix to add to each filename. SO if you input passfile1.txt and passfile2.txt then their output files would be passfile1_sanitized.txt and passfile2_sanitized.txt if the suffix is '_sanitized'.")
     file_args.add_argument("-M", "--file-mode", default="w", choices=['w', 'a'], help="The mode to use when opening the file object. Default: 'w'")
     file_args.add_argument("-D", "--directory", default=".", help="The directory to use for the output files.")
+    file_args.add_argument("--write-buffer", type=int, default=1 << 20, metavar="BYTES", help="The size of each output file's write buffer.")
+    file_args.add_argument("--flush-bytes", type=int, metavar="BYTES", help="Flush output files to the OS after this many bytes. By default they are flushed when the buffer fills.")
+    file_args.add_argument("--flush-interval", type=float, metavar="SECONDS", help="Flush output files to the OS at least this often.")
+    file_args.add_argument("--fsync", default="never", choices=FileHandler.FSYNC_POLICIES, help="When to force output files to disk: never, when they are closed, or on every flush. Checkpoints always sync. Default: 'never'")
+    index_args = parser.add_argument_group("Index Output")
+    index_args.add_argument("--index", metavar="FILE", help="The index file to build. If it exists the new records are added to it. Default: credentials.idx in --directory")
+    index_args.add_argument("--index-key", default="0", help="What to key the index on: a field number, or 'domain' for the domain of field 0. Default: 0")
+    index_args.add_argument("--index-memory", type=int, default=256, metavar="MB", help="The memory budget in MB for sorting records. Beyond it sorted runs are spilled to disk and merged at the end.")
+    index_args.add_argument("--index-block-size", type=int, default=DEFAULT_INDEX_BLOCK_SIZE, help="The number of bytes of records in each compressed block of the index.")
+    sqlite_args = parser.add_argument_group("SQLite Output", "The table and field names are set with --table and --fields.")
+    sqlite_args.add_argument("--sqlite", metavar="FILE", help="The SQLite database to write to. It is created if it doesn't exist. Default: credentials.db in --directory")
+    sqlite_args.add_argument("--sqlite-index", nargs="+", metavar="FIELD", default=[], help="Fields to index once every file has been loaded.")
+    sqlite_args.add_argument("--sqlite-commit", type=int, default=100000, metavar="ROWS", help="The number of rows to insert in each transaction. Ignored with --checkpoint, which commits at every checkpoint instead.")
+    sqlite_args.add_argument("--sqlite-sync", default="NORMAL", choices=["OFF", "NORMAL", "FULL"], help="SQLite's synchronous setting. OFF is fastest, but a crash of the machine (not just credparser) can corrupt the database. Default: 'NORMAL'")
+    sqlite_args.add_argument("--sqlite-cache", type=int, default=64, metavar="MB", help="The size of SQLite's page cache.")
+    partition_args = parser.add_argument_group("Partitioning")
+    partition_args.add_argument("--partitions", type=int, default=0, help="Split the output of every file between this many partitions: files named part_<n> in --directory (SQLite databases with sqlite output), or tables named <table>_<n>.")
+    partition_args.add_argument("--partition-key", default="hash", choices=list(PARTITION_KEYS), help="How to pick each record's partition: a hash of the username, or the domain of the username. Default: 'hash'")
     pg_parser = parser.add_argument_group("Postgres")
     pg_parser.add_argument("-d", "--db", help="Database Name")
     pg_parser.add_argument("-t", "--table", help="Table name to use.")
@@ -31,33 +82,67 @@ def parse_arguments():
     pg_parser.add_argument("--host", default="localhost", help="Host to connect to")
     pg_parser.add_argument("--port", default=5432, help="Port to connect to.")
     pg_parser.add_argument("-f", "--fields", nargs="+", metavar="FIELD", default=["username", "password"], help="The field names to use when inserting data into the database.")
-    pg_parser.add_argument("--commit-freq", type=int, default=1000, help="The frequency (in number of writes) to commit the new data to the database. (specifying --autocommit renders this value useless)")
+    pg_parser.add_argument("--commit-freq", type=int, default=1000, help="The frequency (in number of writes) to commit the new data to the database. (specifying --autocommit or --checkpoint renders this value useless)")
+    pg_parser.add_argument("--copy", action="store_true", default=False, help="Load rows in bulk with COPY ... FROM STDIN instead of one INSERT per row.")
+    pg_parser.add_argument("--flush-size", type=int, default=10000, help="The number of rows to buffer before sending them with COPY. (Only used with --copy)")
+    pg_parser.add_argument("--db-rejects", metavar="FILE", help="A file to append rows the database refused to. They are logged at debug level by default.")
+    pg_parser.add_argument("--pool-size", type=int, default=4, help="The maximum number of database connections to open. It is raised to fit every writer if needed.")
+    pg_parser.add_argument("--writers", type=int, default=1, help="The number of background threads writing to the database. 0 writes from the parsing threads instead.")
+    pg_parser.add_argument("--queue-size", type=int, default=16, help="The number of parsed batches that can wait for a writer before parsing blocks. 0 means no limit.")
     pg_parser.add_argument("--autocommit", action="store_true", default=False, help="Whether to autocommit every database write immediately instead of staging them first. (This can get noisy and I do not know how it will effect performance)")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    if args.partitions and args.output_mode not in ["file", "postgres", "sqlite"]:
+        parser.error("--partitions only works with file, postgres or sqlite output")
+    if args.checkpoint and args.partitions:
+        # Partitions are shared by every file, so one file can't be rolled back on its own.
+        parser.error("--checkpoint can't be used with --partitions")
+    if args.checkpoint and args.output_mode == "index":
+        # The index is only written once every file is done.
+        parser.error("--checkpoint can't be used with index output")
+    if args.checkpoint and args.autocommit:
+        # Rows committed after the last checkpoint would be inserted again on resume.
+        parser.error("--checkpoint can't be used with --autocommit")
+    if args.checkpoint and args.dedup:
+        # What was seen isn't checkpointed, so a resumed run would output duplicates again.
+        parser.error("--checkpoint can't be used with --dedup")
+    if args.checkpoint and (args.output_mode == "stdout" or STDIN in args.files):
+        parser.error("--checkpoint can't be used with standard input or output")
+    if args.fast_delimeter is not None and args.mode == "LOWEST_INDEX":
+        parser.error("--fast-delimeter only works with -m FIRST_FOUND")
+    return args
 
 
-def progress(refresh_freq=1):
+def progress(scheduler: Scheduler, refresh_freq=1):
     last_len = 0
     def blank():
         print(" " * last_len, end="\r")
-    while len(CredentialParser.active_threads()) > 0:
-        statuses = [f"[{str(x)}]" for x in CredentialParser.active_threads()]
+    while scheduler.is_alive():
+        statuses = [f"[{str(x)}]" for x in [scheduler] + CredentialParser.active_threads()]
         joined_statuses = " ".join(statuses)
         blank()
         print(joined_statuses, end="\r")
         last_len = len(joined_statuses)
-        time.sleep(refresh_freq)
+        # Returns as soon as the scheduler is done, so short runs don't wait out the interval.
+        scheduler.join(refresh_freq)
     blank()
 
 def thread_completed(thread: CredentialParser):
-    print(f"{thread.filename} finished in {thread.natural_runtime}.")
+    profile = thread.line_parser.profile
+    details = f" ({profile})" if profile is not None else ""
+    if thread.state == "failed":
+        print(f"{thread.filename} failed after {thread.natural_runtime}: {thread.error}")
+        return
+    print(f"{thread.filename} finished in {thread.natural_runtime}.{details}")
 
 def sighandler(signum, frame):
     global caught_signal
     if caught_signal:
         CredentialParser.stop = True
-    else:
-        caught_signal = True
+        print(f"Stopping... Waiting for pending output to be written.")
+        return
+    caught_signal = True
     print(f"Caught interrupt... Press it again to exit.")
     time.sleep(5)
 
@@ -69,40 +154,189 @@ def set_logging(level=0):
                     else logging.WARNING)
     logging.basicConfig(level=loglevel)
 
-def get_file_handler(args, filepath):
-    filepath = Path(filepath)
+def get_file_handler(args, filepath=None):
+    if filepath is None:
+        # Every file gets its own output file.
+        return None
+    filepath = Path("stdin" if filepath == STDIN else filepath)
+    # Output is never compressed, so drop the compression extension.
+    if filepath.suffix.lower() in COMPRESSION_EXTENSIONS:
+        filepath = filepath.with_suffix("")
     fileext = filepath.suffix
     filename = filepath.stem
     outdir = Path(args.directory)
     outfile = Path(f"{filename}{args.output_suffix}{fileext}")
-    outpath = outdir.joinpath(outfile)
-    return FileHandler(outpath, filemode=args.file_mode, delimiter=args.replacement_delimiter)
+    return make_file_handler(args, outdir.joinpath(outfile))
+
+def make_file_handler(args, outpath):
+    # Resumed output is truncated back to the checkpoint, not overwritten.
+    return FileHandler(outpath,
+                       filemode=args.file_mode,
+                       keep_existing=args.resume,
+                       delimiter=args.replacement_delimiter,
+                       buffer_size=args.write_buffer,
+                       flush_bytes=args.flush_bytes,
+                       flush_interval=args.flush_interval,
+                       fsync=args.fsync)
+
+def get_stdout_handler(args):
+    handler = FileHandler(sys.stdout.fileno(),
+                          filemode="w",
+                          delimiter=args.replacement_delimiter,
+                          buffer_size=args.write_buffer,
+                          flush_bytes=args.flush_bytes,
+                          flush_interval=args.flush_interval)
+    # Records are written straight to the stdout file descriptor.
+    # Progress and everything else printed goes to stderr instead.
+    sys.stdout = sys.stderr
+    if hasattr(signal, "SIGPIPE"):
+        # Exit quietly when whatever is reading the output goes away.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    return handler
+
+def get_db_rejects_handler(args):
+    if args.db_rejects is None:
+        return None
+    return FileHandler(args.db_rejects, filemode="a", delimiter=args.replacement_delimiter)
 
-def get_postgres_handler(args):
+def get_postgres_handler(args, table=None):
+    from CredentialParser.Postgres import PostgresHandler
     return PostgresHandler(username=args.username,
                            password=args.password,
                            database=args.db,
-                           table=args.table,
+                           table=table or args.table,
                            fieldnames=args.fields,
                            host=args.host,
                            port=args.port,
-                           commitfreq=args.commit_freq,
-                           autocommit=args.autocommit)
+                           # Commits have to line up with checkpoints.
+                           commitfreq=None if args.checkpoint else args.commit_freq,
+                           autocommit=args.autocommit,
+                           copy=args.copy,
+                           flush_size=args.flush_size,
+                           rejects_handler=get_db_rejects_handler(args),
+                           pool_size=args.pool_size,
+                           writers=args.writers,
+                           queue_size=args.queue_size)
+
+def get_sqlite_handler(args, path=None):
+    from CredentialParser.Sqlite import SqliteHandler
+    path = path or args.sqlite or os.path.join(args.directory, "credentials.db")
+    return SqliteHandler(path,
+                         table=args.table or "credentials",
+                         fieldnames=args.fields,
+                         indexes=args.sqlite_index,
+                         commit_rows=None if args.checkpoint else args.sqlite_commit,
+                         synchronous=args.sqlite_sync,
+                         cache_size=args.sqlite_cache,
+                         rejects_handler=get_db_rejects_handler(args),
+                         queue_size=args.queue_size)
+
+def get_index_handler(args):
+    path = args.index or os.path.join(args.directory, "credentials.idx")
+    return IndexHandler(path, key=args.index_key, memory_limit=args.index_memory << 20, block_size=args.index_block_size)
+
+def get_partitioned_handler(args):
+    """One sink per partition: tables named <table>_<n>, or files named part_<n><suffix>.txt (or .db)."""
+    width = len(str(args.partitions - 1))
+    if args.output_mode == "postgres":
+        # The shared pool makes room for every table's writers.
+        sinks = [get_postgres_handler(args, table=f"{args.table}_{i:0{width}d}")
+                 for i in range(args.partitions)]
+    elif args.output_mode == "sqlite":
+        # A database file each, since SQLite only has one writer per database.
+        outdir = Path(args.directory)
+        sinks = [get_sqlite_handler(args, outdir.joinpath(f"part_{i:0{width}d}{args.output_suffix}.db"))
+                 for i in range(args.partitions)]
+    else:
+        outdir = Path(args.directory)
+        sinks = [make_file_handler(args, outdir.joinpath(f"part_{i:0{width}d}{args.output_suffix}.txt"))
+                 for i in range(args.partitions)]
+    return PartitionedHandler(sinks, key=args.partition_key)
+
+
+def parse_query_arguments(argv):
+    parser = ArgumentParser("credparser query")
+    parser.add_argument("index", metavar="INDEX", help="An index built with --output-mode index.")
+    parser.add_argument("keys", nargs="+", metavar="KEY", help="The keys to look up. Lookups aren't case sensitive.")
+    parser.add_argument("--prefix", action="store_true", default=False, help="Find every key starting with KEY instead of exact matches.")
+    parser.add_argument("-n", "--limit", type=int, help="The maximum number of records to show for each key.")
+    parser.add_argument("-r", "--replacement-delimiter", default="\t", help="The delimiter to print between fields.")
+    return parser.parse_args(argv)
+
+def query(argv):
+    """Look keys up in an index: credparser query INDEX KEY [KEY ...]"""
+    args = parse_query_arguments(argv)
+    delimiter = args.replacement_delimiter.encode()
+    out = sys.stdout.buffer
+    with IndexReader(args.index) as index:
+        for key in args.keys:
+            for params in index.lookup(key.encode(), prefix=args.prefix, limit=args.limit):
+                out.write(delimiter.join(params) + b"\n")
+    out.flush()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query(sys.argv[2:])
+        return
     signal.signal(signal.SIGINT, sighandler)
     args = parse_arguments()
     set_logging(level=args.verbose)
-    
-    err_handler = LoggingHandler("Debug", log_level=logging.DEBUG)
-    for f in args.files:
-        handler = get_postgres_handler(
-            args) if args.output_mode == "postgres" else get_file_handler(args, f)
-        c = CredentialParser(f, output_handler=handler, parse_mode=ParsingMode.mode_for_str(args.mode), delimiters=args.delimeters, error_handler=err_handler, completion_handler=thread_completed)
-        c.start()
-    progress()
-    
+    files = expand_paths(args.files)
+    if not files:
+        print("No input files found.")
+        sys.exit(1)
+
+    err_handler = RejectsHandler(args.rejects)
+    make_handler = get_factory(args.output_mode)
+    # Unless there is one handler per file, a single handler is shared by every file.
+    shared_handler = get_partitioned_handler(args) if args.partitions else make_handler(args)
+    dedup = Deduplicator(args.dedup_memory << 20, args.dedup_dir) if args.dedup else None
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+
+    def make_parser(f, executor):
+        handler = shared_handler or make_handler(args, f)
+        if dedup is not None:
+            handler = DedupHandler(handler, dedup)
+        return CredentialParser(f, output_handler=handler, parse_mode=ParsingMode.mode_for_str(args.mode), delimiters=args.delimeters, error_handler=err_handler, completion_handler=thread_completed, count_lines=args.count_lines, blocksize=args.block_size, workers=args.jobs, ordered=not args.unordered, executor=executor, profile=not args.no_profile, profile_size=args.profile_size, fast_delimeter=args.fast_delimeter, decompress_threads=args.decompress_threads, checkpoint=checkpoint, checkpoint_interval=args.checkpoint_interval, resume=args.resume)
+
+    # Shared handlers are attached here so they stay open between files.
+    err_handler.attach()
+    if shared_handler is not None:
+        shared_handler.attach()
+    max_running = args.parallel_files
+    if checkpoint is not None and shared_handler is not None:
+        # A flush commits every file's output, so only one file can be
+        # between checkpoints at a time.
+        max_running = 1
+    scheduler = Scheduler(files, make_parser, max_running=max_running, processes=args.jobs)
+    logging.debug(f"Started up in {(time.perf_counter() - IMPORT_STARTED) * 1000:.0f}ms")
+    stats_writer = None
+    if args.stats:
+        Stats.enable(args.stats_sample)
+        stats_writer = StatsWriter(args.stats, scheduler.stats, args.stats_interval)
+    scheduler.start()
+    if stats_writer is not None:
+        stats_writer.start()
+    progress(scheduler, args.refresh_time)
+    scheduler.join()
+    if stats_writer is not None:
+        stats_writer.stop()
+    if shared_handler is not None:
+        shared_handler.detach()
+    postgres = sys.modules.get("CredentialParser.Postgres")
+    if postgres is not None:
+        postgres.PostgresHandler.close_pools()
+    err_handler.detach()
+    print(f"Parsed {scheduler.processed_count} lines from {len(scheduler.finished)} files in {scheduler.natural_runtime}.")
+    print(f"Rejected: {err_handler}.")
+    if dedup is not None:
+        print(f"Deduplication: {dedup}.")
+        dedup.close()
+    if scheduler.failed:
+        print(f"Failed: {', '.join(scheduler.failed)}.")
+        sys.exit(1)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+"""The output modes --output-mode can choose from.
+
+Each mode names a factory function, whose module is only imported when
+the mode is used, so a run doesn't pay for loading handlers (and their
+dependencies, like psycopg2) that it doesn't need. Other packages can
+add modes with an entry point in the "credparser.output_handlers"
+group, pointing at a factory.
+
+A factory is called with the parsed arguments and returns the handler
+shared by every file, or None to be called again with each file's name
+as well, to make one handler per file. When `args.checkpoint` is set,
+handlers should only make output durable in flush(), since anything
+made durable after the last checkpoint is output again on --resume.
+"""
+from importlib import import_module
+from typing import Callable, Dict
+
+ENTRY_POINT_GROUP = "credparser.output_handlers"
+
+BUILTIN_OUTPUT_MODES: Dict[str, str] = {
+    "file": "CredentialParser.cli.credparser:get_file_handler",
+    "stdout": "CredentialParser.cli.credparser:get_stdout_handler",
+    "postgres": "CredentialParser.cli.credparser:get_postgres_handler",
+    "sqlite": "CredentialParser.cli.credparser:get_sqlite_handler",
+    "index": "CredentialParser.cli.credparser:get_index_handler",
+}
+
+
+def plugin_output_modes() -> dict:
+    """The output modes other packages have installed, as entry points by name."""
+    try:
+        # importlib.metadata is slow to import and to scan installed
+        # packages with, so this is only done when it's needed.
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {}
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep for ep in eps if ep.name not in BUILTIN_OUTPUT_MODES}
+
+
+class OutputModes:
+    """Every output mode, for use as argparse choices.
+
+    Checking for a built in mode doesn't look for plugins at all. Only
+    listing the modes (for --help and errors) does.
+    """
+
+    def __contains__(self, name):
+        return name in BUILTIN_OUTPUT_MODES or name in plugin_output_modes()
+
+    def __iter__(self):
+        return iter(list(BUILTIN_OUTPUT_MODES) + list(plugin_output_modes()))
+
+
+def get_factory(name: str) -> Callable:
+    """Import the factory for an output mode."""
+    target = BUILTIN_OUTPUT_MODES.get(name)
+    if target is None:
+        return plugin_output_modes()[name].load()
+    module, _, attr = target.partition(":")
+    return getattr(import_module(module), attr)
@@ -1,6 +1,11 @@
 
 
+import glob
+import logging
+import os
 from datetime import timedelta
+from typing import Iterable, List
+from CredentialParser.Reader import InputFile
 
 
 def str_index(string: bytes, substr: bytes):
@@ -11,6 +16,43 @@ def str_index(string: bytes, substr: bytes):
         return None
 
 
+def count_lines(filename: str, blocksize: int = 1 << 20):
+    """Count lines the same way iterating over the (decompressed) file would."""
+    count = 0
+    last = b""
+    with InputFile(filename, blocksize) as f:
+        while True:
+            block = f.stream.read(blocksize)
+            if not block:
+                break
+            count += block.count(b"\n")
+            last = block
+    if last and not last.endswith(b"\n"):
+        count += 1
+    return count
+
+
+def expand_paths(paths: Iterable[str]) -> List[str]:
+    """Expand directories (recursively) and glob patterns into a list of files.
+
+    Directories and patterns that have no files in them are warned about.
+    """
+    files = []
+    for path in paths:
+        found = len(files)
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif glob.has_magic(path):
+            files.extend(f for f in sorted(glob.glob(path, recursive=True)) if os.path.isfile(f))
+        else:
+            files.append(path)
+        if len(files) == found:
+            logging.warning(f"{path}: no files found")
+    return list(dict.fromkeys(files))
+
+
 def timestr(t: timedelta):
     m, s = divmod(t.total_seconds(), 60)
     h, m = divmod(m, 60)
@@ -22,3 +64,15 @@ def timestr(t: timedelta):
     if s > 0:
         ts.append(f"{s:.0f}s")
     return " ".join(ts)
+
+
+def naturalsize(value) -> str:
+    # humanize is only needed for progress text, so it isn't loaded
+    # until something is shown.
+    import humanize
+    return humanize.naturalsize(value)
+
+
+def naturaldelta(value) -> str:
+    import humanize
+    return humanize.naturaldelta(value)
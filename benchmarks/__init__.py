@@ -0,0 +1,6 @@
+"""Benchmarks for CredentialParser. Not installed with the package.
+
+Generate a dump with `python -m benchmarks.generate` and run the suite
+with `python -m benchmarks.harness`. Startup time is measured by
+`python -m benchmarks.startup`.
+"""
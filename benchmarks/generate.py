@@ -0,0 +1,124 @@
+import random
+import string
+from argparse import ArgumentParser
+from typing import Iterator, List
+
+USER_CHARS = string.ascii_lowercase + string.digits + "._-"
+PASS_CHARS = string.ascii_letters + string.digits + "!@#$%^&*()_+=-[]{}<>?,./"
+DOMAINS = ["gmail.com", "yahoo.com", "hotmail.com", "mail.ru", "web.de", "qq.com", "aol.com", "example.org"]
+LATIN1_CHARS = "àáâäçèéêëìíîïñòóôöùúûüßøåæÀÉÑÖÜ"
+
+
+class DumpGenerator:
+    """Generates lines that look like a real credential dump, reproducibly from a seed.
+
+    Most lines use the first delimiter, as real dumps mostly stick to one.
+    Some passwords contain delimiters themselves, some lines are latin-1
+    encoded instead of UTF-8 and some are malformed (no delimiter, blank
+    or binary junk).
+    """
+
+    def __init__(self,
+                 seed: int = 0,
+                 delimiters: List[str] = [":", ";", "|"],
+                 main_share: float = 0.9,
+                 extra_delimiter_rate: float = 0.05,
+                 latin1_rate: float = 0.02,
+                 malformed_rate: float = 0.01):
+        self.random = random.Random(seed)
+        self.delimiters = delimiters
+        self.main_share = main_share
+        self.extra_delimiter_rate = extra_delimiter_rate
+        self.latin1_rate = latin1_rate
+        self.malformed_rate = malformed_rate
+
+    def username(self) -> str:
+        r = self.random
+        name = "".join(r.choices(USER_CHARS, k=r.randint(4, 16)))
+        if r.random() < 0.7:
+            name = f"{name}@{r.choice(DOMAINS)}"
+        return name
+
+    def password(self) -> str:
+        r = self.random
+        chars = PASS_CHARS
+        if r.random() < self.latin1_rate:
+            chars = PASS_CHARS + LATIN1_CHARS
+        password = "".join(r.choices(chars, k=r.randint(6, 20)))
+        if r.random() < self.extra_delimiter_rate:
+            i = r.randint(0, len(password))
+            password = password[:i] + r.choice(self.delimiters) + password[i:]
+        return password
+
+    def delimiter(self) -> str:
+        if self.random.random() < self.main_share:
+            return self.delimiters[0]
+        return self.random.choice(self.delimiters[1:] or self.delimiters)
+
+    def malformed(self) -> bytes:
+        r = self.random
+        kind = r.randint(0, 2)
+        if kind == 0:
+            return self.username().encode()
+        if kind == 1:
+            return b""
+        return bytes(r.randint(1, 255) for _ in range(r.randint(4, 24))).replace(b"\n", b"")
+
+    def line(self) -> bytes:
+        if self.random.random() < self.malformed_rate:
+            return self.malformed()
+        text = f"{self.username()}{self.delimiter()}{self.password()}"
+        if any(c in LATIN1_CHARS for c in text):
+            return text.encode("latin-1")
+        return text.encode()
+
+    def lines(self, count: int) -> Iterator[bytes]:
+        for _ in range(count):
+            yield self.line()
+
+    def write(self, path: str, count: int) -> int:
+        """Write `count` lines to `path`. Returns the number of bytes written."""
+        size = 0
+        with open(path, "wb") as f:
+            chunk = []
+            for line in self.lines(count):
+                chunk.append(line)
+                if len(chunk) >= 10000:
+                    data = b"\n".join(chunk) + b"\n"
+                    f.write(data)
+                    size += len(data)
+                    chunk = []
+            if chunk:
+                data = b"\n".join(chunk) + b"\n"
+                f.write(data)
+                size += len(data)
+        return size
+
+
+def parse_arguments():
+    parser = ArgumentParser("benchmarks.generate")
+    parser.add_argument("output", help="The file to write.")
+    parser.add_argument("-n", "--lines", type=int, default=1000000, help="The number of lines to generate.")
+    parser.add_argument("--seed", type=int, default=0, help="The random seed. The same seed always gives the same file.")
+    parser.add_argument("-s", "--delimeters", nargs="+", default=[":", ";", "|"], help="The delimeters to use. Most lines use the first one.")
+    parser.add_argument("--main-share", type=float, default=0.9, help="The share of lines using the first delimeter.")
+    parser.add_argument("--extra-delimeter-rate", type=float, default=0.05, help="The share of passwords containing a delimeter.")
+    parser.add_argument("--latin1-rate", type=float, default=0.02, help="The share of lines encoded as latin-1.")
+    parser.add_argument("--malformed-rate", type=float, default=0.01, help="The share of malformed lines.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    generator = DumpGenerator(seed=args.seed,
+                              delimiters=args.delimeters,
+                              main_share=args.main_share,
+                              extra_delimiter_rate=args.extra_delimeter_rate,
+                              latin1_rate=args.latin1_rate,
+                              malformed_rate=args.malformed_rate)
+    size = generator.write(args.output, args.lines)
+    print(f"Wrote {args.lines} lines ({size} bytes) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
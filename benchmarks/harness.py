@@ -0,0 +1,193 @@
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import SUPPRESS, ArgumentParser
+from datetime import datetime
+from typing import List
+from CredentialParser.CredentialParser import CredentialParser, ParsingMode
+from CredentialParser.OutputHandler import FileHandler, OutputHandler
+from CredentialParser.Postgres import PostgresHandler
+from CredentialParser.Scheduler import Scheduler
+from CredentialParser.Sqlite import SqliteHandler
+from benchmarks.generate import DumpGenerator
+from benchmarks.pgstub import StandInConnection
+
+HANDLERS = ["null", "file", "postgres", "postgres-copy", "sqlite"]
+DELIMITERS = [":", ";", "|"]
+
+
+class NullHandler(OutputHandler):
+    """Counts records and throws them away, to measure parsing on its own."""
+
+    accepts_bytes = True
+
+    def do_output(self, params):
+        pass
+
+    def do_output_batch(self, records):
+        self.output_count += len(records)
+
+
+def case_name(case: dict) -> str:
+    return f"{case['mode']}/{case['handler']}/jobs={case['jobs']}/files={case['parallel_files']}"
+
+
+def make_inputs(workdir: str, files: int, lines: int, seed: int) -> List[str]:
+    """Generate the input files, reusing ones from an earlier run with the same settings."""
+    paths = []
+    for i in range(files):
+        path = os.path.join(workdir, f"dump_s{seed}_n{lines}_{i}.txt")
+        if not os.path.exists(path):
+            DumpGenerator(seed=seed + i).write(path, lines)
+        paths.append(path)
+    return paths
+
+
+def run_case(case: dict) -> dict:
+    """Parse the inputs once with the case's settings and measure it. Run in a fresh process."""
+    files = case["files"]
+    outdir = tempfile.mkdtemp(prefix="credparser-bench-")
+    error_handler = NullHandler()
+    shared = None
+    if case["handler"].startswith("postgres"):
+        shared = PostgresHandler("bench", "", "bench", "credentials",
+                                 commitfreq=10000,
+                                 copy=case["handler"] == "postgres-copy",
+                                 connection_factory=StandInConnection)
+        shared.attach()
+    elif case["handler"] == "sqlite":
+        shared = SqliteHandler(os.path.join(outdir, "bench.db"), indexes=["username"])
+        shared.attach()
+
+    def make_parser(filename, executor):
+        if shared is not None:
+            handler = shared
+        elif case["handler"] == "file":
+            handler = FileHandler(os.path.join(outdir, os.path.basename(filename)), filemode="w")
+        else:
+            handler = NullHandler()
+        return CredentialParser(filename,
+                                delimiters=DELIMITERS,
+                                parse_mode=ParsingMode.mode_for_str(case["mode"]),
+                                output_handler=handler,
+                                error_handler=error_handler,
+                                blocksize=case["block_size"],
+                                workers=case["jobs"],
+                                executor=executor)
+
+    start = time.perf_counter()
+    scheduler = Scheduler(files, make_parser, max_running=case["parallel_files"], processes=case["jobs"])
+    scheduler.start()
+    scheduler.join()
+    if shared is not None:
+        shared.detach()
+        PostgresHandler.close_pools()
+    seconds = time.perf_counter() - start
+    shutil.rmtree(outdir)
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return dict(name=case_name(case),
+                mode=case["mode"],
+                handler=case["handler"],
+                jobs=case["jobs"],
+                parallel_files=case["parallel_files"],
+                seconds=seconds,
+                lines=scheduler.processed_count,
+                bytes=scheduler.processed_bytes,
+                lines_per_sec=scheduler.processed_count / seconds,
+                bytes_per_sec=scheduler.processed_bytes / seconds,
+                peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                peak_child_rss=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def run_isolated(case: dict) -> dict:
+    """Run a case in its own interpreter so peak memory isn't shared between cases."""
+    result = subprocess.run([sys.executable, "-m", "benchmarks.harness", "--run-case", json.dumps(case)],
+                            stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout)
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> List[str]:
+    """Return the names of cases whose lines/sec dropped more than `threshold` below the baseline."""
+    before = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        change = result["lines_per_sec"] / old["lines_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(result["name"])
+            flag = "  REGRESSION"
+        print(f"{result['name']:<45} {old['lines_per_sec']:>12,.0f} -> {result['lines_per_sec']:>12,.0f} lines/s ({change:+.1%}){flag}")
+    return regressions
+
+
+def parse_arguments():
+    parser = ArgumentParser("benchmarks.harness")
+    parser.add_argument("--run-case", help=SUPPRESS)
+    parser.add_argument("-n", "--lines", type=int, default=500000, help="The number of lines in each generated input file.")
+    parser.add_argument("--files", type=int, default=2, help="The number of input files.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed for the generated input.")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "credparser-bench"), help="Where generated input files are kept between runs.")
+    parser.add_argument("-m", "--modes", nargs="+", default=[m.name for m in ParsingMode], choices=[m.name for m in ParsingMode])
+    parser.add_argument("--handlers", nargs="+", default=HANDLERS, choices=HANDLERS)
+    parser.add_argument("-j", "--jobs", nargs="+", type=int, default=[0, 2], help="Worker process counts to try. 0 parses each file on its own thread.")
+    parser.add_argument("-P", "--parallel-files", nargs="+", type=int, default=[1, 2], help="Numbers of files to parse at once.")
+    parser.add_argument("--block-size", type=int, default=1 << 20)
+    parser.add_argument("--repeat", type=int, default=3, help="Run each case this many times and keep the fastest.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare against the JSON results of an earlier run.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="The slowdown (as a fraction) that counts as a regression.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    files = make_inputs(args.workdir, args.files, args.lines, args.seed)
+    results = []
+    for mode, handler, jobs, parallel_files in itertools.product(args.modes, args.handlers, args.jobs, args.parallel_files):
+        case = dict(mode=mode, handler=handler, jobs=jobs, parallel_files=parallel_files,
+                    block_size=args.block_size, files=files)
+        runs = [run_isolated(case) for _ in range(args.repeat)]
+        best = max(runs, key=lambda r: r["lines_per_sec"])
+        results.append(best)
+        print(f"{best['name']:<45} {best['lines_per_sec']:>12,.0f} lines/s {best['bytes_per_sec'] / 1e6:>8.1f} MB/s "
+              f"{best['peak_rss'] / 1e6:>8.1f} MB peak")
+
+    output = dict(meta=dict(date=datetime.now().isoformat(timespec="seconds"),
+                            python=platform.python_version(),
+                            platform=platform.platform(),
+                            cpus=os.cpu_count(),
+                            seed=args.seed,
+                            lines=args.lines,
+                            files=args.files,
+                            repeat=args.repeat),
+                  results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, output, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} cases regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
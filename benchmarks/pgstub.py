@@ -0,0 +1,59 @@
+"""A local stand-in for a psycopg2 connection, so Postgres output can be benchmarked offline.
+
+It is passed to PostgresHandler as its `connection_factory`. Statements
+and COPY data are consumed and counted but not stored, so what is
+measured is the handler's own overhead: formatting, batching, queueing
+and the writer threads. Server round trips aren't modelled, so it can't
+compare ways of writing whose cost is mostly round trips, like inserting
+one row per statement against batches or COPY.
+"""
+
+
+class StandInCursor:
+    def __init__(self, conn: 'StandInConnection'):
+        self.conn = conn
+
+    def mogrify(self, query, params) -> bytes:
+        return (query % tuple(f"'{p}'" for p in params)).encode()
+
+    def execute(self, query, params=None):
+        if params is not None:
+            query = self.mogrify(query, params)
+        if isinstance(query, bytes):
+            query = query.decode()
+        if query.startswith(("SAVEPOINT", "RELEASE", "ROLLBACK")):
+            return
+        self.conn.statements += 1
+        self.conn.pending += query.count(";") + 1
+
+    def copy_expert(self, query, fileobj):
+        self.conn.statements += 1
+        self.conn.pending += fileobj.read().count("\n")
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    def __init__(self):
+        self.statements = 0
+        self.pending = 0
+        self.rows = 0
+        self.commits = 0
+
+    def set_session(self, autocommit=False):
+        pass
+
+    def cursor(self) -> StandInCursor:
+        return StandInCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        self.rows += self.pending
+        self.pending = 0
+
+    def rollback(self):
+        self.pending = 0
+
+    def close(self):
+        pass
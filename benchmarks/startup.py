@@ -0,0 +1,92 @@
+"""Measures how long credparser takes to start, for the short runs batch scripts launch on small files.
+
+Each case runs the CLI in a fresh interpreter and keeps the fastest of
+`--repeat` runs. The time spent importing the CLI is taken from
+`python -X importtime`, which is steadier than wall clock time.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import List
+from benchmarks.generate import DumpGenerator
+
+CLI = [sys.executable, "-m", "CredentialParser.cli.credparser"]
+HEAVY_MODULES = ["psycopg2", "humanize", "sqlite3", "importlib.metadata"]
+IMPORTTIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| CredentialParser\.cli\.credparser$", re.MULTILINE)
+
+
+def cases(workdir: str, input_file: str) -> dict:
+    """The command lines to time, by name."""
+    outdir = ["-D", workdir]
+    return {
+        "import": [sys.executable, "-c", "import CredentialParser.cli.credparser"],
+        "help": CLI + ["--help"],
+        "file": CLI + [input_file, "-o", "file"] + outdir,
+        "stdout": CLI + [input_file, "-o", "stdout"],
+        "sqlite": CLI + [input_file, "-o", "sqlite", "--sqlite", os.path.join(workdir, "startup.db")] + outdir,
+        "index": CLI + [input_file, "-o", "index", "--index", os.path.join(workdir, "startup.idx")] + outdir,
+    }
+
+
+def loaded_modules(command: List[str]) -> List[str]:
+    """Which of the slow to import modules a command loads."""
+    result = subprocess.run(command[:1] + ["-X", "importtime"] + command[1:],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True)
+    imported = set(re.findall(r"^import time:.*\|\s+(\S+)$", result.stderr, re.MULTILINE))
+    return [m for m in HEAVY_MODULES if m in imported]
+
+
+def import_time() -> float:
+    """Seconds spent importing the CLI and the package, from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import CredentialParser.cli.credparser"],
+                            stderr=subprocess.PIPE, check=True, text=True)
+    return int(IMPORTTIME.search(result.stderr).group(1)) / 1e6
+
+
+def run(command: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def parse_arguments():
+    parser = ArgumentParser("benchmarks.startup")
+    parser.add_argument("-n", "--lines", type=int, default=1000, help="The number of lines in the input file.")
+    parser.add_argument("--repeat", type=int, default=10, help="Run each case this many times and keep the fastest.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare against the JSON results of an earlier run.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="The slowdown (as a fraction) that counts as a regression.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    workdir = tempfile.mkdtemp(prefix="credparser-startup-")
+    input_file = os.path.join(workdir, "small.txt")
+    DumpGenerator().write(input_file, args.lines)
+    results = {"import_time": min(import_time() for _ in range(args.repeat))}
+    print(f"{'import_time':<16} {results['import_time'] * 1000:>8.1f} ms")
+    for name, command in cases(workdir, input_file).items():
+        results[name] = min(run(command) for _ in range(args.repeat))
+        print(f"{name:<16} {results[name] * 1000:>8.1f} ms  loads {' '.join(loaded_modules(command)) or 'nothing slow'}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(lines=args.lines, repeat=args.repeat, results=results), f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = [name for name, seconds in results.items()
+                       if name in baseline and seconds > baseline[name] * (1 + args.threshold)]
+        for name in regressions:
+            print(f"{name} regressed: {baseline[name] * 1000:.1f} ms -> {results[name] * 1000:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,7 +36,11 @@ setup(
 
     keywords='credparser',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
 
     install_requires=['argparse', 'psycopg2-binary', 'humanize'],
+
+    extras_require={
+        'zstd': ['zstandard'],
+    },
 )
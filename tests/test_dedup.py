@@ -0,0 +1,35 @@
+import random
+import pytest
+from CredentialParser.Dedup import Deduplicator
+
+
+@pytest.mark.parametrize("memory_limit", [1 << 17, 1 << 19, 64 << 20])
+def test_filter_matches_a_set(memory_limit):
+    # The small limits freeze, spill and merge runs many times over.
+    rnd = random.Random(memory_limit)
+    dedup = Deduplicator(memory_limit, max_runs=3)
+    seen = set()
+    try:
+        for _ in range(600):
+            records = [[str(rnd.randrange(90000)).encode(), b"password"] for _ in range(rnd.randrange(1, 900))]
+            expected = []
+            for params in records:
+                if params[0] not in seen:
+                    seen.add(params[0])
+                    expected.append(params)
+            assert dedup.filter(records) == expected
+        assert dedup.seen_count - dedup.duplicates == len(seen)
+        assert len(dedup.runs) <= 3
+    finally:
+        dedup.close()
+
+
+def test_contains():
+    dedup = Deduplicator(1 << 17)
+    try:
+        dedup.filter([["user", str(i)] for i in range(10000)])
+        assert dedup.runs
+        assert dedup.contains(Deduplicator.key(["user", "1"]))
+        assert not dedup.contains(Deduplicator.key(["user", "x"]))
+    finally:
+        dedup.close()
@@ -0,0 +1,40 @@
+from queue import Queue
+from threading import Thread
+from CredentialParser.OutputHandler import FlushRequest, STOP_DRAINING, drain_queue
+
+
+def flush_through(queue: Queue) -> bool:
+    request = FlushRequest(1)
+    queue.put(request)
+    return request.wait()
+
+
+def test_write_failure_is_reported_by_the_next_flush():
+    written = []
+
+    def write(records):
+        if records == ["bad"]:
+            raise ValueError("can't write that")
+        written.extend(records)
+
+    queue = Queue()
+    writer = Thread(target=drain_queue, args=(queue, write, lambda: True, "Test writer"), daemon=True)
+    writer.start()
+    queue.put(["bad"])
+    queue.put(["good"])
+    # The failure isn't lost by the flush after it succeeding.
+    assert not flush_through(queue)
+    assert flush_through(queue)
+    queue.put(STOP_DRAINING)
+    writer.join(5)
+    assert not writer.is_alive()
+    assert written == ["good"]
+
+
+def test_failed_flush_is_reported():
+    queue = Queue()
+    writer = Thread(target=drain_queue, args=(queue, lambda records: None, lambda: False, "Test writer"), daemon=True)
+    writer.start()
+    assert not flush_through(queue)
+    queue.put(STOP_DRAINING)
+    writer.join(5)
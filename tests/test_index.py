@@ -0,0 +1,80 @@
+import random
+import pytest
+from CredentialParser.Index import IndexHandler, IndexReader
+
+
+def build(path, records, **kwargs):
+    handler = IndexHandler(path, **kwargs)
+    handler.attach()
+    handler.output_batch(records)
+    handler.detach()
+
+
+def expected(records, match) -> list:
+    """The unique records whose (lowercased) key matches, as lookups return them."""
+    return sorted({tuple(params) for params in records if match(params[0].lower())})
+
+
+def found(reader, key, **kwargs) -> list:
+    return sorted(tuple(params) for params in reader.lookup(key, **kwargs))
+
+
+SPECIAL = [[b"tab\tkey", b"p\tw"], [b"new\nline", b"p\nw"], [b"back\\slash", b"x\\y"], [b"back\\x41", b"\\x41"],
+           [b"ctl\x01\x1f", b"\r\x00"], [b"tab", b"plain"], [b"TAB\tKEY", b"upper"]]
+
+
+def test_special_characters_round_trip(tmp_path):
+    path = str(tmp_path / "creds.idx")
+    build(path, SPECIAL)
+    with IndexReader(path) as reader:
+        assert len(reader) == len(SPECIAL)
+        for params in SPECIAL:
+            key = params[0]
+            assert found(reader, key) == expected(SPECIAL, lambda k: k == key.lower())
+        assert found(reader, b"tab\tkey") == [(b"TAB\tKEY", b"upper"), (b"tab\tkey", b"p\tw")]
+
+
+def test_matches_across_block_boundaries(tmp_path):
+    path = str(tmp_path / "creds.idx")
+    rnd = random.Random(1)
+    keys = [b"alice", b"bob", b"carol", b"dave"]
+    records = [[rnd.choice(keys), b"pw%d" % rnd.randrange(400)] for _ in range(2000)]
+    # Tiny blocks and memory limit, so every key spans many blocks and many runs are merged.
+    build(path, records, block_size=64, memory_limit=4096, max_fanin=3)
+    with IndexReader(path) as reader:
+        assert reader.block_count > 100
+        assert len(reader) == len(expected(records, lambda k: True))
+        for key in keys + [b"ALICE", b"aaron", b"bo", b"zed"]:
+            assert found(reader, key) == expected(records, lambda k: k == key.lower())
+        assert len(list(reader.lookup(b"bob", limit=5))) == 5
+
+
+def test_prefix_lookups(tmp_path):
+    path = str(tmp_path / "creds.idx")
+    records = [[b"user%d@example.com" % i, b"pw"] for i in range(300)] + SPECIAL
+    build(path, records, block_size=128)
+    with IndexReader(path) as reader:
+        for prefix in [b"user1", b"USER2", b"user29", b"user", b"tab", b"back\\", b"u", b"nobody", b""]:
+            assert found(reader, prefix, prefix=True) == expected(records, lambda k: k.startswith(prefix.lower()))
+        assert len(list(reader.lookup(b"user", prefix=True, limit=7))) == 7
+
+
+def test_second_batch_is_merged_into_existing_index(tmp_path):
+    path = str(tmp_path / "creds.idx")
+    first = [[b"user%d" % i, b"old"] for i in range(0, 200, 2)] + SPECIAL[:3]
+    second = [[b"user%d" % i, b"new"] for i in range(0, 200, 3)] + SPECIAL
+    build(path, first, block_size=100)
+    build(path, second, block_size=100)
+    both = first + second
+    with IndexReader(path) as reader:
+        assert len(reader) == len(expected(both, lambda k: True))
+        for key in [b"user0", b"user2", b"user3", b"user1", b"new\nline", b"tab"]:
+            assert found(reader, key) == expected(both, lambda k: k == key.lower())
+        assert found(reader, b"user1", prefix=True) == expected(both, lambda k: k.startswith(b"user1"))
+
+
+def test_existing_index_with_another_key_is_refused(tmp_path):
+    path = str(tmp_path / "creds.idx")
+    build(path, SPECIAL)
+    with pytest.raises(ValueError):
+        IndexHandler(path, key="domain")
@@ -0,0 +1,56 @@
+import pytest
+from CredentialParser.CredentialParser import LineParser, ParsingMode
+from CredentialParser.util import str_index
+
+LINES = [b"user@x.com:pass", b"  user:pa:ss  \r", b"user;pass|x", b"user|pass;x", b"nodelim", b"", b":", b"a:",
+         b"xab:y", b"aab", b"bab", b"abab", b"ba", b"user\xe9:p\xe4ss", b"\xff\xfe;x", b"caf\xc3\xa9|b"]
+
+DELIMETERS = [[b":", b";", b"|"], [b"|", b";", b":"], [b"ab", b"b"], [b"a", b"ab"], [b"b", b"ab", b":"], [b";"]]
+
+
+def old_get_delimeter(val: bytes, delimeters, parse_mode):
+    """How a delimeter was picked for each line before lines were parsed in batches."""
+    if parse_mode == ParsingMode.FIRST_FOUND:
+        for d in delimeters:
+            if d in val:
+                return d
+    elif parse_mode == ParsingMode.LOWEST_INDEX:
+        delim = None
+        delim_ind = None
+        for d in delimeters:
+            ind = str_index(val, d)
+            if ind is not None and (delim_ind is None or ind < delim_ind):
+                delim = d
+                delim_ind = ind
+        return delim
+
+
+def old_parse(parser: LineParser, lines):
+    records, errors = [], []
+    for val in lines:
+        val = val.strip()
+        delim = old_get_delimeter(val, parser.delimeters, parser.parse_mode)
+        if delim is None:
+            errors.append((f"Couldn't determine delimeter.", val))
+            continue
+        vals = val.split(delim)
+        vals = vals[:parser.num_values - 1] + [delim.join(vals[parser.num_values - 1:])]
+        records.append(parser.attempt_decode(vals))
+    return records, errors
+
+
+@pytest.mark.parametrize("parse_mode", [ParsingMode.FIRST_FOUND, ParsingMode.LOWEST_INDEX])
+@pytest.mark.parametrize("delimeters", DELIMETERS, ids=repr)
+@pytest.mark.parametrize("num_values", [2, 3])
+def test_parse_lines_matches_per_line_parsing(parse_mode, delimeters, num_values):
+    parser = LineParser(delimeters, num_values, parse_mode)
+    assert parser.parse_lines(LINES) == old_parse(parser, LINES)
+
+
+@pytest.mark.parametrize("delimeters", DELIMETERS, ids=repr)
+def test_fast_delimeter_matches_per_line_parsing(delimeters):
+    parser = LineParser(delimeters)
+    expected = old_parse(parser, LINES)
+    for fast in delimeters:
+        parser.set_fast_delimeter(fast)
+        assert parser.parse_lines(LINES) == expected
@@ -0,0 +1,24 @@
+import threading
+from benchmarks.pgstub import StandInConnection
+from CredentialParser.Postgres import PostgresHandler
+
+
+def test_more_writers_than_pool_connections():
+    done = []
+
+    def open_handlers():
+        handlers = [PostgresHandler("test", "", "test", f"credentials_{i}", pool_size=4, writers=5,
+                                    connection_factory=StandInConnection) for i in range(2)]
+        for handler in handlers:
+            handler.attach()
+            handler.output_batch([["user", "pass"]] * 10)
+        done.extend(handler.flush() for handler in handlers)
+        for handler in handlers:
+            handler.detach()
+
+    # Run on a daemon thread, so a deadlock fails the test instead of hanging it.
+    thread = threading.Thread(target=open_handlers, daemon=True)
+    thread.start()
+    thread.join(10)
+    PostgresHandler.close_pools()
+    assert done == [True, True]
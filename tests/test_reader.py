@@ -0,0 +1,108 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import threading
+import zlib
+import pytest
+from CredentialParser.Reader import BlockReader, InputFile, compression_from_head, detect_compression
+
+TEXT = b"BZhang@x.com:pw1\nuser@y.com:pw2\n"
+
+COMPRESSORS = {
+    "gzip": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+}
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSORS))
+@pytest.mark.parametrize("data", [TEXT, b""])
+def test_detected_by_magic(tmp_path, compression, data):
+    path = tmp_path / "dump.txt"
+    path.write_bytes(COMPRESSORS[compression](data))
+    assert detect_compression(str(path)) == compression
+    with InputFile(str(path)) as f:
+        assert f.stream.read() == data
+
+
+def test_zstd_detected_by_magic():
+    assert compression_from_head(b"\x28\xb5\x2f\xfd\x00\x00\x00\x00\x00\x00", "dump.txt") == "zstd"
+
+
+@pytest.mark.parametrize("head", [TEXT[:10], b"BZh", b"BZh9", b"BZh0AY&SY", b"BZh91AY&SX"])
+def test_text_starting_with_bz2_header_is_not_bz2(head):
+    assert compression_from_head(head, "dump.txt") is None
+
+
+def test_plain_text_starting_with_bzh(tmp_path):
+    path = tmp_path / "dump.txt"
+    path.write_bytes(TEXT)
+    assert detect_compression(str(path)) is None
+    with InputFile(str(path)) as f:
+        assert f.stream.read() == TEXT
+
+
+@pytest.mark.parametrize("name,compression", [("dump.gz", "gzip"), ("dump.BZ2", "bz2"), ("dump.lzma", "xz"),
+                                              ("dump.zst", "zstd"), ("dump.txt", None)])
+def test_falls_back_to_extension(name, compression):
+    assert compression_from_head(b"user:pass\n", name) == compression
+
+
+@pytest.mark.parametrize("data", [b"", b"\n", b"a:b", b"a:b\n", b"a:b\n\nc:d", b"x" * 100 + b"\ny:z\n" + b"q" * 50,
+                                  b"\r" * 70 + b"\n" + b"r" * 33])
+@pytest.mark.parametrize("blocksize", [1, 3, 16, 1 << 20])
+def test_block_reader_matches_line_iteration(data, blocksize):
+    reader = BlockReader(io.BytesIO(data), blocksize)
+    assert [line for lines in reader for line in lines] == [line.rstrip(b"\n") for line in io.BytesIO(data)]
+    assert reader.offset == len(data)
+
+
+def bgzf_compress(data: bytes) -> bytes:
+    """A single BGZF block: a gzip member with its size in a "BC" extra field."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = 18 + len(deflated) + 8
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + (size - 1).to_bytes(2, "little")
+    return header + deflated + zlib.crc32(data).to_bytes(4, "little") + len(data).to_bytes(4, "little")
+
+
+def test_bgzf_detected_by_magic(tmp_path):
+    path = tmp_path / "dump.txt"
+    path.write_bytes(bgzf_compress(TEXT) * 3)
+    assert detect_compression(str(path)) == "gzip"
+    with InputFile(str(path), threads=2) as f:
+        assert f.executor is not None
+        assert b"".join(iter(f.stream.read, b"")) == TEXT * 3
+
+
+@pytest.mark.parametrize("compress", [None, gzip.compress, bgzf_compress], ids=["plain", "gzip", "bgzf"])
+def test_stream_blocks_are_read_as_they_arrive(tmp_path, compress):
+    path = str(tmp_path / "fifo")
+    os.mkfifo(path)
+    data = b"a:b\nc:d\n"
+    release = threading.Event()
+    released = []
+
+    def write():
+        with open(path, "wb") as fifo:
+            fifo.write(compress(data) if compress else data)
+            fifo.flush()
+            released.append(release.wait(5))
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        # The writer keeps the pipe open, so this would block until it
+        # closed if a whole block had to arrive first.
+        with InputFile(path) as f:
+            assert f.stream.peek(1) == data
+            assert next(iter(BlockReader(f.stream, 1 << 20))) == [b"a:b", b"c:d"]
+            # Closing waits for the reading thread, which waits for the writer.
+            release.set()
+    finally:
+        release.set()
+        writer.join(5)
+    # Only read once the writer gave up waiting and closed the pipe.
+    assert released == [True]
@@ -0,0 +1,123 @@
+"""Kill credparser part way through a checkpointed run, resume it, and check nothing was lost or repeated."""
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import Counter
+import pytest
+from benchmarks.generate import DumpGenerator
+from benchmarks.pgstub import StandInConnection
+from CredentialParser.Postgres import PostgresHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = [sys.executable, "-m", "CredentialParser.cli.credparser"]
+
+
+@pytest.fixture(scope="module")
+def dump(tmp_path_factory):
+    """A dump big enough to take a few seconds to parse."""
+    path = tmp_path_factory.mktemp("input") / "dump.txt"
+    chunk = tmp_path_factory.mktemp("chunk") / "chunk.txt"
+    DumpGenerator(seed=1).write(str(chunk), 20000)
+    data = chunk.read_bytes()
+    with open(path, "wb") as f:
+        for _ in range(100):
+            f.write(data)
+    return str(path)
+
+
+def outdir(tmp_path, name):
+    path = tmp_path / name
+    path.mkdir()
+    return path
+
+
+def run(args, **kwargs):
+    return subprocess.Popen(CLI + args + ["-s", ":", ";", "|"], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+
+
+def checkpoint_offset(path) -> int:
+    try:
+        with open(path) as f:
+            return max((entry["offset"] for entry in json.load(f).values()), default=0)
+    except (OSError, ValueError):
+        return 0
+
+
+def kill_when(process, ready, delay=0.0, timeout=60):
+    """SIGKILL `process` `delay` seconds after `ready()` is true."""
+    deadline = time.monotonic() + timeout
+    while not ready():
+        if process.poll() is not None:
+            pytest.fail("credparser finished before it could be killed")
+        if time.monotonic() > deadline:
+            process.kill()
+            pytest.fail("timed out waiting to kill credparser")
+        time.sleep(0.01)
+    time.sleep(delay)
+    if process.poll() is not None:
+        pytest.fail("credparser finished before it could be killed")
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+
+def killed_and_resumed(args, checkpoint, ready, delay=0.0):
+    kill_when(run(args + ["--checkpoint", checkpoint]), ready, delay)
+    assert run(args + ["--checkpoint", checkpoint, "--resume"]).wait() == 0
+
+
+def test_file_output_killed_before_first_checkpoint(dump, tmp_path):
+    assert run([dump, "-D", str(outdir(tmp_path, "ref"))]).wait() == 0
+    out = outdir(tmp_path, "out")
+    output = out / "dump_sanitized.txt"
+    killed_and_resumed([dump, "-D", str(out), "--checkpoint-interval", "3600"], str(tmp_path / "ck.json"),
+                       lambda: output.exists() and output.stat().st_size > 0)
+    assert output.read_bytes() == (tmp_path / "ref" / "dump_sanitized.txt").read_bytes()
+
+
+def test_file_output_killed_between_checkpoints(dump, tmp_path):
+    assert run([dump, "-D", str(outdir(tmp_path, "ref")), "-j", "2"]).wait() == 0
+    out = outdir(tmp_path, "out")
+    checkpoint = str(tmp_path / "ck.json")
+    killed_and_resumed([dump, "-D", str(out), "-j", "2", "--checkpoint-interval", "0.1"], checkpoint,
+                       lambda: checkpoint_offset(checkpoint) > 0)
+    assert (out / "dump_sanitized.txt").read_bytes() == (tmp_path / "ref" / "dump_sanitized.txt").read_bytes()
+
+
+def test_sqlite_output_killed_between_checkpoints(dump, tmp_path):
+    assert run([dump, "-D", str(tmp_path)]).wait() == 0
+    with open(tmp_path / "dump_sanitized.txt", encoding="utf8", newline="\n") as f:
+        expected = Counter(f.read().split("\n")[:-1])
+    db = str(tmp_path / "out.db")
+    checkpoint = str(tmp_path / "ck.json")
+    # Killed part way between two checkpoints, after a small commit size
+    # would have committed rows that the resumed run outputs again.
+    killed_and_resumed([dump, "-o", "sqlite", "--sqlite", db, "--sqlite-commit", "1000", "--checkpoint-interval", "2"],
+                       checkpoint, lambda: checkpoint_offset(checkpoint) > 0, delay=0.5)
+    with sqlite3.connect(db) as conn:
+        rows = Counter("\t".join(row) for row in conn.execute("SELECT username, password FROM credentials"))
+    assert rows == expected
+
+
+def test_postgres_only_commits_on_flush():
+    connections = []
+
+    def connect():
+        connections.append(StandInConnection())
+        return connections[-1]
+
+    handler = PostgresHandler("test", "", "test", "credentials", commitfreq=None, writers=2,
+                              connection_factory=connect)
+    handler.attach()
+    for _ in range(50):
+        handler.output_batch([["user", "pass"]] * 100)
+    # Give the writers time to drain the queue, which must not commit anything.
+    time.sleep(0.2)
+    assert sum(conn.rows for conn in connections) == 0
+    assert handler.flush()
+    assert sum(conn.rows for conn in connections) == 5000
+    handler.detach()
+    PostgresHandler.close_pools()
@@ -0,0 +1,22 @@
+import logging
+from CredentialParser.Scheduler import Scheduler
+from CredentialParser.util import expand_paths
+
+
+def test_missing_files_are_failed_not_fatal(tmp_path):
+    small = tmp_path / "small.txt"
+    small.write_text("a:b\n")
+    big = tmp_path / "big.txt"
+    big.write_text("a:b\n" * 10)
+    missing = str(tmp_path / "missing.txt")
+    scheduler = Scheduler([str(small), missing, str(big)], lambda f, executor: None)
+    assert scheduler.files == [str(big), str(small)]
+    assert scheduler.failed == [missing]
+
+
+def test_patterns_without_files_are_warned_about(tmp_path, caplog):
+    (tmp_path / "a.txt").write_text("a:b\n")
+    with caplog.at_level(logging.WARNING):
+        files = expand_paths([str(tmp_path / "*.txt"), str(tmp_path / "*.zzz")])
+    assert files == [str(tmp_path / "a.txt")]
+    assert "*.zzz: no files found" in caplog.text
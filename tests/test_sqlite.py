@@ -0,0 +1,29 @@
+import sqlite3
+from CredentialParser.OutputHandler import OutputHandler
+from CredentialParser.Sqlite import SqliteHandler
+
+
+class ListHandler(OutputHandler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def do_output(self, params):
+        self.records.append(params)
+
+
+def test_bad_rows_are_rejected_and_the_rest_written(tmp_path):
+    path = str(tmp_path / "creds.db")
+    rejects = ListHandler()
+    handler = SqliteHandler(path, rejects_handler=rejects)
+    handler.attach()
+    good = [[f"user{i}", "pass"] for i in range(20)]
+    # The wrong number of fields fails the insert.
+    bad = [["user", "pass", "extra"], ["lonely"]]
+    handler.output_batch(good[:7] + bad[:1] + good[7:15] + bad[1:] + good[15:])
+    assert handler.flush()
+    handler.detach()
+    handler.writer.join(5)
+    assert rejects.records == bad
+    with sqlite3.connect(path) as conn:
+        assert [list(row) for row in conn.execute("SELECT username, password FROM credentials")] == good